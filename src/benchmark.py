@@ -0,0 +1,187 @@
+# pylint: disable=missing-docstring,invalid-name
+
+import argparse
+import json
+import os
+import sys
+import tempfile
+
+import numpy as np
+
+from profiling import ParseStats
+from synthetic import generate_dat
+
+import formats
+
+
+def benchmark(nfile=4, nstep=40, ntrial=100, nsample=28, noise=8.,
+              jitter=0., random_seed=0, repeat=1, directory=None, **options):
+    """
+    Generates synthetic .dat files and parses them, and returns the parse and
+    fit throughput along with the accuracy of the recovered pedestals and
+    gains (see generate_dat).
+    :param int nfile: Number of files (one per channel group, cycling).
+    :param int nstep: Number of injection steps.
+    :param int ntrial: Number of events per step.
+    :param int nsample: Number of samples per pulse.
+    :param float noise: Standard deviation of the sample noise.
+    :param float jitter: Relative spread of the pulse shape parameters.
+    :param int random_seed: Seed of the random number generator.
+    :param int repeat: Number of times each file is parsed (the best time is
+        kept).
+    :param str directory: Directory for the generated files, or None for a
+        temporary directory.
+    :param options: Options passed to DataFormat_v1.parser.
+    """
+    with tempfile.TemporaryDirectory() as temp:
+        directory = directory or temp
+
+        files, truth = [], []
+
+        for n in range(nfile):
+            path = os.path.join(directory,
+                'synthetic_{}_Channel{}.dat'.format(n, (n % 4) * 16))
+
+            files.append(path)
+            truth.append(generate_dat(path, group=n % 4, nstep=nstep,
+                ntrial=ntrial, nsample=nsample, noise=noise, jitter=jitter,
+                seed=random_seed + n))
+
+        parser = formats.DataFormat_v1()
+
+        size = sum(os.path.getsize(f) for f in files)
+        stages = {}
+        pedes, gains, errors = [], [], 0
+
+        for raw, t in zip(files, truth):
+            best = None
+
+            for _ in range(repeat):
+                stats = ParseStats()
+                entry, _, _, _, pars, _ = parser.parser(raw, stats=stats,
+                    **options)
+
+                run = stats.runs[-1]['stages']
+                if best is None or run['total']['time'] < best['total']['time']:
+                    best = run
+
+            for name, stage in best.items():
+                total = stages.setdefault(name, {})
+                for k, v in stage.items():
+                    total[k] = total.get(k, 0) + v
+
+            pedes.append(pars[:,0] - t['pedestal'])
+            gains.append(pars[:,1] / t['gain'] - 1.)
+
+            if entry['comment']:
+                errors += len(entry['comment'].split('; '))
+
+        pedes = np.concatenate(pedes)
+        gains = np.concatenate(gains)
+
+    def rate(count, stage):
+        t = stages.get(stage, {}).get('time', 0.)
+        return count / t if t > 0 else float('nan')
+
+    nevent = nfile * nstep * ntrial
+    nfit = stages.get('pulse_fit', {}).get('fits', 0)
+
+    return {
+        'config': {
+            'nfile': nfile, 'nstep': nstep, 'ntrial': ntrial,
+            'nsample': nsample, 'noise': noise, 'jitter': jitter,
+            'options': { k: repr(v) for k, v in options.items() },
+        },
+        'throughput': {
+            'files/s': rate(nfile, 'total'),
+            'MB/s': rate(size / 1e6, 'total'),
+            'events/s': rate(nevent, 'decode'),
+            'fits/s': rate(nfit, 'pulse_fit'),
+        },
+        'accuracy': {
+            'pedestal bias': float(np.mean(pedes)),
+            'pedestal rms': float(np.sqrt(np.mean(pedes * pedes))),
+            'gain bias': float(np.mean(gains)),
+            'gain rms': float(np.sqrt(np.mean(gains * gains))),
+            'parser errors': errors,
+        },
+        'stages': stages,
+    }
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Benchmarks the ADC parser on synthetic data files.'
+    )
+    parser.add_argument('--files', type=int, default=4,
+                        help='number of files (default: %(default)s)')
+    parser.add_argument('--steps', type=int, default=40,
+                        help='injection steps per file (default: %(default)s)')
+    parser.add_argument('--events', type=int, default=100,
+                        help='events per step (default: %(default)s)')
+    parser.add_argument('--samples', type=int, default=28,
+                        help='samples per pulse (default: %(default)s)')
+    parser.add_argument('--noise', type=float, default=8.,
+                        help='sample noise (default: %(default)s)')
+    parser.add_argument('--jitter', type=float, default=0.,
+                        help='relative spread of the pulse shape between '
+                             'channels (default: %(default)s)')
+    parser.add_argument('--random-seed', type=int, default=0,
+                        help='random number generator seed '
+                             '(default: %(default)s)')
+    parser.add_argument('--repeat', type=int, default=1,
+                        help='parses per file, best time kept '
+                             '(default: %(default)s)')
+    parser.add_argument('--fitter', default='batch', choices=('batch', 'scipy', 'template'),
+                        help='pulse fitter (default: %(default)s)')
+    parser.add_argument('--seed', default='default', choices=('default', 'warm'),
+                        help='pulse fit seed (default: %(default)s)')
+    parser.add_argument('--dtype', default='float64',
+                        choices=('float64', 'float32'),
+                        help='data type of the statistics (default: %(default)s)')
+    parser.add_argument('--json', default=None,
+                        help='write the results to a JSON file')
+    parser.add_argument('--max-pedestal-rms', type=float, default=None,
+                        help='fail if the pedestal rms error (ADC counts) is '
+                             'larger')
+    parser.add_argument('--max-gain-rms', type=float, default=None,
+                        help='fail if the relative gain rms error is larger')
+    parser.add_argument('--min-fits', type=float, default=None,
+                        help='fail if there are fewer pulse fits per second')
+
+    args = parser.parse_args()
+
+    results = benchmark(args.files, args.steps, args.events, args.samples,
+        args.noise, args.jitter, args.random_seed, args.repeat,
+        fitter=args.fitter, seed=args.seed, dtype=args.dtype)
+
+    for group in ('throughput', 'accuracy'):
+        for k, v in results[group].items():
+            print('{:<16} {:>14.6g}'.format(k, v))
+
+    if args.json is not None:
+        with open(args.json, 'w') as fp:
+            json.dump(results, fp, indent=2)
+
+    checks = [
+        ('pedestal rms', results['accuracy']['pedestal rms'],
+            args.max_pedestal_rms, np.greater),
+        ('gain rms', results['accuracy']['gain rms'],
+            args.max_gain_rms, np.greater),
+        ('fits/s', results['throughput']['fits/s'],
+            args.min_fits, np.less),
+    ]
+
+    failed = False
+
+    for name, value, limit, exceeds in checks:
+        if limit is not None and (exceeds(value, limit) or np.isnan(value)):
+            print(' [!] FAILED: {} {:.6g} (limit: {:.6g})'.format(
+                name, value, limit))
+            failed = True
+
+    sys.exit(1 if failed else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,158 @@
+# pylint: disable=missing-docstring,invalid-name
+
+import hashlib
+import json
+import os
+import tempfile
+
+import numpy as np
+
+
+class ParseCache:
+    """
+    Creates an on-disk cache of parser results. Each result is stored as a
+    compressed .npz file, keyed by the raw file (path, size, modification time
+    and content hash), the parser version and the parser options. Least
+    recently used results are evicted once the cache exceeds its size limit.
+    """
+    fields = ('mean', 'sigma', 'y', 'pars', 'errs')
+
+    def __init__(self, path, size=512 * 1024 * 1024, enabled=True):
+        """
+        Initializes a ParseCache object.
+        :param str path: The directory holding the cached results.
+        :param int size: Maximum total size of the cache, in bytes.
+        :param bool enabled: Whether results are looked up and stored.
+        """
+        self.path = path
+        self.size = size
+        self.enabled = enabled
+
+        self.digests = {}
+
+        os.makedirs(self.path, exist_ok=True)
+
+    def digest(self, raw):
+        """
+        Hashes the contents of a raw data file. Hashes are remembered for as
+        long as the file size and modification time do not change.
+        :param str raw: Path to the raw data file.
+        """
+        stat = os.stat(raw)
+        ident = (os.path.abspath(raw), stat.st_size, stat.st_mtime_ns)
+
+        if ident not in self.digests:
+            sha = hashlib.sha1()
+
+            with open(raw, 'rb') as fp:
+                while chunk := fp.read(1 << 20):
+                    sha.update(chunk)
+
+            self.digests[ident] = sha.hexdigest()
+
+        return ident, self.digests[ident]
+
+    def key(self, raw, parser, **kwargs):
+        """
+        Builds the cache key of a parser result.
+        :param str raw: Path to the raw data file.
+        :param DataFormat parser: The data format object parsing the file.
+        :param kwargs: Parser options that affect the result.
+        """
+        ident, digest = self.digest(raw)
+
+        text = json.dumps([
+            ident,
+            digest,
+            type(parser).__name__,
+            getattr(parser, 'revision', 0),
+            sorted((k, repr(v)) for k, v in kwargs.items()),
+        ])
+
+        return hashlib.sha1(text.encode()).hexdigest()
+
+    def load(self, key):
+        """
+        Loads a cached parser result, or returns None if it is absent.
+        :param str key: The cache key.
+        """
+        if not self.enabled:
+            return None
+
+        path = os.path.join(self.path, '{}.npz'.format(key))
+
+        try:
+            with np.load(path, allow_pickle=False) as npz:
+                entry = json.loads(str(npz['entry']))
+                result = [npz[x] if x in npz else None for x in self.fields]
+        except (OSError, ValueError, KeyError):
+            return None
+
+        # mark as recently used
+        os.utime(path)
+
+        return (entry, *result)
+
+    def store(self, key, result):
+        """
+        Stores a parser result, then evicts old results if needed.
+        :param str key: The cache key.
+        :param tuple result: The parser result, (entry, mean, sigma, y, pars,
+            errs).
+        """
+        if not self.enabled or result is None:
+            return
+
+        entry, *arrays = result
+
+        data = { k: v for k, v in zip(self.fields, arrays) if v is not None }
+        data['entry'] = np.array(json.dumps(entry))
+
+        fd, temp = tempfile.mkstemp(suffix='.tmp', dir=self.path)
+
+        try:
+            with os.fdopen(fd, 'wb') as fp:
+                np.savez_compressed(fp, **data)
+
+            os.replace(temp, os.path.join(self.path, '{}.npz'.format(key)))
+        except OSError:
+            if os.path.exists(temp):
+                os.remove(temp)
+            return
+
+        self.evict()
+
+    def evict(self):
+        """
+        Removes the least recently used results until the cache fits within
+        its size limit.
+        """
+        files = []
+
+        for f in os.scandir(self.path):
+            if f.name.endswith('.npz') and f.is_file():
+                stat = f.stat()
+                files.append((stat.st_mtime_ns, stat.st_size, f.path))
+
+        total = sum(x[1] for x in files)
+
+        for _, size, path in sorted(files):
+            if total <= self.size:
+                break
+
+            try:
+                os.remove(path)
+            except OSError:
+                continue
+
+            total -= size
+
+    def clear(self):
+        """
+        Removes all cached results.
+        """
+        for f in os.scandir(self.path):
+            if f.name.endswith('.npz') and f.is_file():
+                os.remove(f.path)
+
+        self.digests.clear()
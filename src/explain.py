@@ -0,0 +1,71 @@
+# pylint: disable=missing-docstring,invalid-name
+
+import argparse
+import sys
+
+from helper import SquashHelper
+
+
+# lookups made by pumpkin.py (duplicate checks, search shortcuts, updates)
+# and ingest.py (batch selection), with placeholder values
+LOOKUPS = {
+    'serial': {'serial': 'E000000'},
+    'id': {'id': '0'},
+    'serials': {'serial': ['E000000', 'E000001']},
+}
+
+
+def explain(path, migrate=False, log=print):
+    """
+    Prints the query plans of the lookups made by the graphical interface on a
+    database, and returns the names of the lookups that scan the whole table
+    instead of searching an index.
+    :param str path: The system path to the SQLite database.
+    :param bool migrate: Build the missing indexes first (see
+        SquashHelper.migrate).
+    :param function log: Output function.
+    """
+    helper = SquashHelper(path)
+
+    if helper.object is None:
+        raise ValueError('unknown database version: {}'.format(path))
+
+    if migrate:
+        for name in helper.migrate():
+            log(' [!] index not built: {}'.format(name))
+
+    scans = []
+
+    for name, where in LOOKUPS.items():
+        plan = helper.explain(where)
+
+        log('{}: {}'.format(name, '; '.join(plan)))
+
+        if any(x.startswith('SCAN') for x in plan):
+            scans.append(name)
+
+    helper.close()
+
+    return scans
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Checks that the lookups of pumpkin.py use indexes.'
+    )
+    parser.add_argument('database', help='path to the SQLite database')
+    parser.add_argument('--migrate', action='store_true',
+                        help='build the missing indexes first')
+
+    args = parser.parse_args()
+
+    scans = explain(args.database, args.migrate)
+
+    if scans:
+        print(' [!] full table scan: {}'.format(', '.join(scans)))
+
+    sys.exit(1 if scans else 0)
+
+
+if __name__ == '__main__':
+    main()
@@ -1,13 +1,19 @@
+import logging
+
 import matplotlib.pyplot as plt
 import numpy as np
 from scipy.optimize import curve_fit
 
 from utils import (
+    ParseError,
     powerlaw_doubleexp,
+    powerlaw_doubleexp_jac,
     powerlaw_doubleexp_part0,
     powerlaw_doubleexp_part1,
 )
 
+logger = logging.getLogger(__name__)
+
 
 def fit_signal(mean, sigma, nsamples, pulse, channel, **kwargs):
     """
@@ -18,7 +24,7 @@ def fit_signal(mean, sigma, nsamples, pulse, channel, **kwargs):
     :param XXX pulse: 
     :param XXX channel: 
     """
-    print('pulse: {}, channel: {}'.format(pulse, channel))
+    logger.debug('pulse: %d, channel: %d', pulse, channel)
 
     x = np.array(range(nsamples))
     y = mean[pulse,channel,:]
@@ -30,6 +36,8 @@ def fit_signal(mean, sigma, nsamples, pulse, channel, **kwargs):
     bmin = [        0.0, 0.0, -np.inf, -np.inf, -np.inf,  0.0, -np.inf]
     bmax = [       amax, 8.0,  np.inf,  np.inf,  np.inf,  1.0,  np.inf]
 
+    kwargs.setdefault('jac', powerlaw_doubleexp_jac)
+
     popt, pcov = curve_fit(powerlaw_doubleexp, x, y, sigma=w, p0=pval,
         bounds=(bmin, bmax), **kwargs)
 
@@ -43,6 +51,468 @@ def fit_signal(mean, sigma, nsamples, pulse, channel, **kwargs):
     return popt, pcov
 
 
+@np.errstate(all='ignore')
+def fit_signal_batch(mean, sigma, maxiter=200, ftol=1e-8, xtol=1e-8, p0=None,
+                     full_output=False):
+    """
+    Fits powerlaw_doubleexp to a batch of pulses at once, with a bounded
+    Levenberg-Marquardt iteration over stacked arrays. Each pulse converges
+    (and stops iterating) independently.
+    :param array mean: Pulses to fit, (..., nsamples).
+    :param array sigma: Uncertainties of the pulse samples, or None.
+    :param int maxiter: Maximum number of iterations.
+    :param float ftol: Relative tolerance on the change of the cost.
+    :param float xtol: Relative tolerance on the change of the parameters.
+    :param array p0: Initial parameters, (..., 7), clipped to the bounds.
+        Pulses (or parameters) that are not finite use the default seed.
+    :param bool full_output: Also return a dict of per-pulse counters: 'nit'
+        (iterations), 'nfev' (function evaluations), 'njev' (Jacobian
+        evaluations) and 'success' (converged before maxiter, without error).
+    """
+    shape = mean.shape[:-1]
+    nsamples = mean.shape[-1]
+
+    x = np.arange(nsamples, dtype=np.float64)
+    y = mean.reshape(-1, nsamples).astype(np.float64)
+    w = (
+        sigma.reshape(-1, nsamples).astype(np.float64)
+        if sigma is not None else np.ones_like(y)
+    )
+
+    n = y.shape[0]
+    amax = np.amax(y, axis=1, initial=0.)
+
+    pval = np.column_stack([
+        amax * 0.76,
+        np.full(n, 3.5),
+        np.full(n, 0.66),
+        np.full(n, 0.96),
+        y[:,0] if nsamples else np.zeros(n),
+        np.full(n, 0.56),
+        np.full(n, 2.77),
+    ])
+    bmin = np.tile([0.0, 0.0, -np.inf, -np.inf, -np.inf, 0.0, -np.inf], (n, 1))
+    bmax = np.column_stack([
+        amax,
+        np.full(n, 8.0),
+        np.full((n, 3), np.inf),
+        np.full(n, 1.0),
+        np.full(n, np.inf),
+    ])
+
+    if p0 is not None:
+        p0 = np.asarray(p0, dtype=np.float64).reshape(n, 7)
+        pval = np.clip(np.where(np.isfinite(p0), p0, pval), bmin, bmax)
+
+    def residuals(p, idx):
+        return (powerlaw_doubleexp(x, *p.T[...,None]) - y[idx]) / w[idx]
+
+    def jacobian(p, idx):
+        return powerlaw_doubleexp_jac(x, *p.T[...,None]) / w[idx][...,None]
+
+    everything = np.arange(n)
+
+    popt = pval.copy()
+    res = residuals(popt, everything)
+    cost = np.sum(res * res, axis=1)
+
+    ierr = np.where(
+        np.isfinite(cost) & (amax > 0), ParseError.NONE, ParseError.FIT
+    ).astype(np.int32)
+
+    active = ierr == ParseError.NONE
+    damping = np.full(n, 1e-3)
+
+    jtj = np.zeros((n, 7, 7))
+    jtr = np.zeros((n, 7))
+    stale = np.ones(n, dtype=bool)
+
+    nit = np.zeros(n, dtype=np.int64)
+    njev = np.zeros(n, dtype=np.int64)
+    done = ~active
+
+    for _ in range(maxiter):
+        idx = np.flatnonzero(active)
+        if not idx.size:
+            break
+
+        nit[idx] += 1
+
+        # the normal equations only change when a step is accepted
+        if np.any(stale[idx]):
+            sidx = idx[stale[idx]]
+            jac = jacobian(popt[sidx], sidx)
+            jtj[sidx] = np.einsum('nsi,nsj->nij', jac, jac)
+            jtr[sidx] = np.einsum('nsi,ns->ni', jac, res[sidx])
+            stale[sidx] = False
+            njev[sidx] += 1
+
+        scale = np.maximum(np.diagonal(jtj[idx], axis1=1, axis2=2), 1e-12)
+        lhs = jtj[idx] + (damping[idx,None] * scale)[...,None] * np.eye(7)
+
+        try:
+            delta = np.linalg.solve(lhs, -jtr[idx][...,None])[...,0]
+        except np.linalg.LinAlgError:
+            delta = (np.linalg.pinv(lhs) @ -jtr[idx][...,None])[...,0]
+
+        pold = popt[idx]
+        pnew = np.clip(pold + delta, bmin[idx], bmax[idx])
+        rnew = residuals(pnew, idx)
+        cnew = np.sum(rnew * rnew, axis=1)
+
+        better = np.isfinite(cnew) & (cnew < cost[idx])
+
+        dcost = cost[idx] - cnew
+        dstep = np.linalg.norm(pnew - pold, axis=1)
+
+        converged = (
+            (better & (dcost <= ftol * cost[idx]))
+            | (dstep <= xtol * (xtol + np.linalg.norm(pold, axis=1)))
+        )
+
+        aidx = idx[better]
+        popt[aidx] = pnew[better]
+        res[aidx] = rnew[better]
+        cost[aidx] = cnew[better]
+        stale[aidx] = True
+
+        damping[idx] = np.where(better,
+            np.maximum(damping[idx] / 10., 1e-12), damping[idx] * 10.)
+
+        # no downhill step left to take
+        stuck = damping[idx] > 1e12
+
+        active[idx[converged | stuck]] = False
+        done[idx[converged | stuck]] = True
+
+    pcov = np.full((n, 7, 7), np.inf)
+
+    idx = np.flatnonzero(ierr == ParseError.NONE)
+    if idx.size:
+        jac = jacobian(popt[idx], idx)
+
+        finite = np.all(np.isfinite(jac), axis=(1, 2))
+        idx, jac = idx[finite], jac[finite]
+
+        dof = nsamples - 7
+        if idx.size and dof > 0:
+            jtj = np.einsum('nsi,nsj->nij', jac, jac)
+            pcov[idx] = np.linalg.pinv(jtj, hermitian=True) * (
+                cost[idx] / dof)[:,None,None]
+
+    ierr[~np.all(np.isfinite(popt), axis=1)] = ParseError.FIT
+
+    result = (
+        popt.reshape(shape + (7,)),
+        pcov.reshape(shape + (7, 7)),
+        ierr.reshape(shape),
+    )
+
+    if not full_output:
+        return result
+
+    info = {
+        'nit': nit.reshape(shape),
+        'nfev': (nit + 1).reshape(shape),
+        'njev': njev.reshape(shape),
+        'success': (done & (ierr == ParseError.NONE)).reshape(shape),
+    }
+
+    return (*result, info)
+
+
+def fit_signal_warm(mean, sigma, valid=None, **kwargs):
+    """
+    Fits powerlaw_doubleexp to the pulses of every step (see
+    fit_signal_batch), seeding each pulse with the converged parameters of the
+    same channel at a neighbouring step, with the amplitude scaled by the
+    change of the pulse height. Steps are fitted from the largest pulses down,
+    in waves of doubling size (1, 2, 4, ... steps), each seeded from the
+    nearest step (in pulse height) of the previous waves. Pulses without a
+    converged neighbour start from the default seed, and warm-started fits
+    that fail are repeated from it. Returns popt, pcov and ierr as
+    fit_signal_batch, and a dict of counters (see full_output) with an
+    additional 'retry' flag. Pulses that are not fitted are marked with
+    ParseError.FIT.
+    :param array mean: Pulses to fit, (nstep, nchannel, nsamples).
+    :param array sigma: Uncertainties of the pulse samples, or None.
+    :param array valid: Pulses to fit, (nstep, nchannel), or None for all.
+    :param kwargs: Options passed to fit_signal_batch.
+    """
+    nstep, nchannel, _ = mean.shape
+
+    if valid is None:
+        valid = np.ones((nstep, nchannel), dtype=bool)
+
+    popt = np.full((nstep, nchannel, 7), np.nan)
+    pcov = np.full((nstep, nchannel, 7, 7), np.inf)
+    ierr = np.full((nstep, nchannel), ParseError.FIT, dtype=np.int32)
+
+    info = {
+        k: np.zeros((nstep, nchannel), dtype=np.int64)
+        for k in ('nit', 'nfev', 'njev')
+    }
+    info['success'] = np.zeros((nstep, nchannel), dtype=bool)
+    info['retry'] = np.zeros((nstep, nchannel), dtype=bool)
+
+    with np.errstate(all='ignore'):
+        height = np.amax(mean, axis=-1) - mean[...,0]
+        order = np.argsort(-np.nanmedian(np.where(valid, height, np.nan), axis=1))
+
+    def fit(index, seed):
+        m = mean[index]
+        s = sigma[index] if sigma is not None else None
+
+        p, c, e, out = fit_signal_batch(m, s, p0=seed, full_output=True,
+            **kwargs)
+
+        popt[index], pcov[index], ierr[index] = p, c, e
+        info['success'][index] = out['success']
+        for k in ('nit', 'nfev', 'njev'):
+            info[k][index] += out[k]
+
+        return out['success']
+
+    start, size = 0, 1
+
+    while start < nstep:
+        wave, done = order[start:start + size], order[:start]
+        start, size = start + size, size * 2
+
+        index = np.nonzero(valid[wave])
+        if not index[0].size:
+            continue
+
+        steps, channels = wave[index[0]], index[1]
+
+        # nearest converged pulse of the same channel in the previous waves
+        with np.errstate(all='ignore'):
+            distance = np.abs(
+                height[steps,channels][:,None] - height[done][:,channels].T)
+            distance[~info['success'][done][:,channels].T] = np.inf
+
+        seed = np.full((steps.size, 7), np.nan)
+
+        if done.size:
+            k = np.argmin(distance, axis=1)
+            warm = np.isfinite(distance[np.arange(k.size), k])
+
+            with np.errstate(all='ignore'):
+                scale = height[steps,channels] / height[done[k],channels]
+
+            warm &= np.isfinite(scale) & (scale > 0)
+
+            seed[warm] = popt[done[k],channels][warm]
+            seed[warm,0] *= scale[warm]
+        else:
+            warm = np.zeros(steps.size, dtype=bool)
+
+        success = fit((steps, channels), seed)
+
+        retry = warm & ~success
+        if np.any(retry):
+            info['retry'][steps[retry],channels[retry]] = True
+            fit((steps[retry], channels[retry]), None)
+
+    return popt, pcov, ierr, info
+
+
+@np.errstate(all='ignore')
+def make_template(mean, sigma, valid=None, **kwargs):
+    """
+    Builds a pulse shape template per channel, from a powerlaw_doubleexp fit
+    (see fit_signal_batch) of the largest valid pulse of the channel. Each
+    template is the fitted shape without pedestal, scaled to a maximum of 1.
+    Channels whose reference fit fails use the median template of the other
+    channels. Returns the templates, (nchannel, nsamples), all nan if no
+    reference fit succeeds.
+    :param array mean: Pulses, (nstep, nchannel, nsamples).
+    :param array sigma: Uncertainties of the pulse samples, or None.
+    :param array valid: Pulses that may be used, (nstep, nchannel), or None
+        for all.
+    :param kwargs: Options passed to fit_signal_batch.
+    """
+    nstep, nchannel, nsamples = mean.shape
+
+    height = np.amax(mean, axis=-1) - mean[...,0]
+    if valid is not None:
+        height = np.where(valid, height, -np.inf)
+
+    ref = np.argmax(height, axis=0)
+    channels = np.arange(nchannel)
+
+    popt, _, ierr = fit_signal_batch(mean[ref,channels],
+        sigma[ref,channels] if sigma is not None else None, **kwargs)
+
+    shape = popt.copy()
+    shape[:,0] = 1.
+    shape[:,4] = 0.
+
+    x = np.arange(nsamples)
+
+    template = powerlaw_doubleexp(x, *shape.T[...,None])
+    peak = find_pulse_maximum(shape, nsamples)
+    template /= peak[:,None]
+
+    good = (
+        np.isfinite(height[ref,channels]) & (ierr == ParseError.NONE)
+        & (peak > 0) & np.all(np.isfinite(template), axis=1)
+    )
+
+    if not np.any(good):
+        return np.full((nchannel, nsamples), np.nan)
+
+    template[~good] = np.median(template[good], axis=0)
+
+    return template
+
+
+def fit_template(mean, template):
+    """
+    Fits every pulse as a pedestal plus a scaled template, by linear least
+    squares: the pseudo-inverses of the (pedestal, template) design matrices
+    of the channels are applied to all pulses with a single matrix product.
+    Returns the pedestals and amplitudes (the pulse maxima above the
+    pedestals, for templates with a maximum of 1), (nstep, nchannel).
+    :param array mean: Pulses, (nstep, nchannel, nsamples).
+    :param array template: Pulse shape templates, (nchannel, nsamples) or
+        (nsamples,).
+    """
+    nstep, nchannel, nsamples = mean.shape
+
+    template = np.broadcast_to(np.asarray(template, dtype=np.float64),
+        (nchannel, nsamples))
+
+    design = np.stack((np.ones_like(template), template), axis=-1)
+
+    pars = np.full((nstep, nchannel, 2), np.nan)
+
+    finite = np.all(np.isfinite(template), axis=1)
+    if np.any(finite):
+        pinv = np.linalg.pinv(design[finite])
+        pars[:,finite] = np.einsum('cks,ics->ick', pinv, mean[:,finite])
+
+    return pars[...,0], pars[...,1]
+
+
+@np.errstate(all='ignore')
+def fit_linear_batch(x, y, w=None, bmin=(-np.inf, -np.inf),
+                     bmax=(np.inf, np.inf)):
+    """
+    Fits linear to many data sets at once, with a closed-form weighted least
+    squares solution bounded to [bmin, bmax]. When the unbounded solution is
+    out of bounds, the best solution along the bounds is kept. Returns the
+    parameters and their standard errors (scaled by the residual variance,
+    as curve_fit), both (n, 2).
+    :param array x: The independent variable, (npoints,).
+    :param array y: Data sets to fit, (n, npoints).
+    :param array w: Weights of the data points, (n, npoints), or None. Points
+        with a zero weight are ignored.
+    :param array bmin: Lower bounds of (a, b).
+    :param array bmax: Upper bounds of (a, b).
+    """
+    x = np.asarray(x, dtype=np.float64)
+    y = np.asarray(y, dtype=np.float64)
+    w = np.ones_like(y) if w is None else np.asarray(w, dtype=np.float64)
+
+    s0 = np.sum(w, axis=1)
+    sx = w @ x
+    sxx = w @ (x * x)
+    sy = np.sum(w * y, axis=1)
+    sxy = np.sum(w * y * x, axis=1)
+    syy = np.sum(w * y * y, axis=1)
+
+    det = s0 * sxx - sx * sx
+
+    (amin, bmin), (amax, bmax) = bmin, bmax
+
+    # unbounded solution, then the best point along each of the bounds
+    candidates = [
+        ((sy * sxx - sx * sxy) / det, (s0 * sxy - sx * sy) / det),
+    ]
+    for a in (amin, amax):
+        candidates.append((np.full_like(s0, a),
+            np.clip((sxy - a * sx) / sxx, bmin, bmax)))
+    for b in (bmin, bmax):
+        candidates.append((np.clip((sy - b * sx) / s0, amin, amax),
+            np.full_like(s0, b)))
+
+    a, b = np.stack(candidates, axis=1)
+    cost = (
+        syy - 2 * a * sy - 2 * b * sxy
+        + a * a * s0 + 2 * a * b * sx + b * b * sxx
+    )
+
+    feasible = (
+        np.isfinite(cost)
+        & (a >= amin) & (a <= amax) & (b >= bmin) & (b <= bmax)
+    )
+    cost = np.where(feasible, cost, np.inf)
+
+    k = np.argmin(cost, axis=0)
+    i = np.arange(k.size)
+
+    popt = np.column_stack((a[k,i], b[k,i]))
+    cost = np.maximum(cost[k,i], 0.)
+
+    dof = np.count_nonzero(w, axis=1) - 2
+    scale = np.where(dof > 0, cost / dof, np.inf)
+
+    perr = np.sqrt(np.column_stack((sxx, s0)) / det[:,None] * scale[:,None])
+
+    return popt, perr
+
+
+@np.errstate(all='ignore')
+def find_pulse_maximum(popt, nsamples, resolution=0.05, nsteps=4):
+    """
+    Finds the maxima of fitted pulses, by evaluating every pulse on a dense
+    grid of sample positions and refining the best grid point with a few
+    Newton steps.
+    :param array popt: Fitted powerlaw_doubleexp parameters, (..., 7).
+    :param int nsamples: Number of samples per pulse (the search range).
+    :param float resolution: Grid spacing, in samples.
+    :param int nsteps: Number of Newton steps.
+    """
+    popt = np.asarray(popt, dtype=np.float64)
+    shape = popt.shape[:-1]
+    p = popt.reshape(-1, 7).T
+
+    grid = np.arange(0., nsamples - 1 + resolution / 2, resolution)
+
+    values = powerlaw_doubleexp(grid, *p[...,None])
+    values = np.where(np.isfinite(values), values, -np.inf)
+
+    k = np.argmax(values, axis=1)
+
+    x = grid[k]
+    best = values[np.arange(k.size), k]
+
+    def slope(x):
+        # the model depends on x only through x - b
+        return -powerlaw_doubleexp_jac(x, *p)[...,1]
+
+    xmin = x - resolution
+    xmax = x + resolution
+
+    h = 1e-4
+    for _ in range(nsteps):
+        d1 = slope(x)
+        d2 = (slope(x + h) - slope(x - h)) / (2 * h)
+
+        xnew = np.clip(x - d1 / d2, xmin, xmax)
+        vnew = powerlaw_doubleexp(xnew, *p)
+
+        better = (d2 < 0) & np.isfinite(vnew) & (vnew > best)
+
+        x = np.where(better, xnew, x)
+        best = np.where(better, vnew, best)
+
+    best[~np.isfinite(best)] = np.nan
+
+    return best.reshape(shape)
+
+
 def overlay_fit(x, y, yerr, popt):
     """
     Draws each component of the fit separately, for debugging purposes.
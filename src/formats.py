@@ -1,34 +1,48 @@
 # pylint: disable=missing-docstring,invalid-name
 
 from abc import ABC, abstractmethod
+from concurrent.futures import ProcessPoolExecutor
 from datetime import datetime
 from enum import IntEnum
-import os
-import sys
+import io
+import logging
+import mmap
+import time
 
 import numpy as np
 from numpy.polynomial import Polynomial
-from scipy.optimize import curve_fit, fmin
 
-from fitting import fit_signal
+from fitting import (
+    find_pulse_maximum,
+    fit_signal,
+    fit_linear_batch,
+    fit_signal_batch,
+    fit_signal_warm,
+    fit_template,
+    make_template,
+)
 from utils import (
-    read_and_discard_lines,
+    CONTAINER_MAGIC,
+    ParseError,
+    decode_dwords,
+    index_lines,
     read_config_line,
+    read_container,
+    write_container,
     split_dword,
-    linear,
-    powerlaw_doubleexp,
 )
+from profiling import ParseStats
+
+logger = logging.getLogger(__name__)
 
 
-class ParseError(IntEnum):
+class ParseStage(IntEnum):
     """
-    Class for handling parser error types.
+    Class for selecting how far the parser processes data.
     """
-    NONE = 0
-    SIGMA = 1
-    PSAT = 2
-    PZERO = 3
-    FIT = 4
+    DECODE = 1
+    PULSE = 2
+    CALIBRATE = 3
 
 
 errm = {
@@ -68,6 +82,95 @@ class DataParseError(DataFormatError):
         super().__init__(message)
 
 
+def moments(total, total2, count, dtype=np.float64):
+    """
+    Computes the mean and standard deviation from integer sums of values and
+    of squared values. The sums are exact, so only the final division rounds.
+    :param array total: Sums of values.
+    :param array total2: Sums of squared values.
+    :param int count: Number of values summed.
+    :param dtype dtype: Data type of the results (computed in float64).
+    """
+    mean = total / count
+    sigma = np.sqrt((total2 * count - total * total) / count**2)
+
+    return mean.astype(dtype, copy=False), sigma.astype(dtype, copy=False)
+
+
+def screen_pulses(mean, sigma):
+    """
+    Classifies all pulses before fitting, and returns the error codes of
+    pulses that should not be fitted, (16, nstep).
+    :param array mean: Mean ADC values, (nstep, 16, nsample).
+    :param array sigma: ADC value standard deviations, (nstep, 16, nsample).
+    """
+    with np.errstate(divide='ignore', invalid='ignore'):
+        rels = sigma / mean
+
+    flat = np.any(sigma == 0, axis=-1)
+
+    checks = [
+        (ParseError.SIGMA, np.any(rels > 0.1, axis=-1)),
+        (ParseError.PSAT, flat & np.any(mean == 16384, axis=-1)),
+        (ParseError.PZERO, flat & np.any(mean == 0, axis=-1)),
+    ]
+
+    errc = np.zeros(mean.shape[:-1], dtype=np.int32)
+
+    # earlier checks take precedence
+    for err, mask in reversed(checks):
+        errc[mask] = int(err)
+
+    return np.ascontiguousarray(errc.T)
+
+
+def fit_pulse(mean, sigma, nsample, pulse, channel):
+    """
+    Fits a single pulse and finds its maximum.
+    :param array mean: Mean ADC values, (nstep, 16, nsample).
+    :param array sigma: ADC value standard deviations, (nstep, 16, nsample).
+    :param int nsample: Number of samples per pulse.
+    :param int pulse: Step (pulse) index.
+    :param int channel: Channel index.
+    """
+    try:
+        popt, pcov = fit_signal(mean, sigma, nsample, pulse, channel,
+            method='dogbox')
+        value = float(find_pulse_maximum(popt, nsample))
+    except (ValueError, np.linalg.LinAlgError):
+        return 0., ParseError.FIT
+    except RuntimeError:
+        return 0., ParseError.NONE
+
+    if not np.isfinite(value):
+        return 0., ParseError.FIT
+
+    return value, ParseError.NONE
+
+
+_fit_state = None
+
+
+def _init_fit_worker(mean, sigma, nsample):
+    """
+    Stores the pulse statistics once per worker process, so that fit tasks
+    only need to carry their indices.
+    """
+    global _fit_state
+
+    _fit_state = (mean, sigma, nsample)
+
+
+def _fit_step(step):
+    """
+    Fits the selected channels of a single step in a worker process.
+    :param tuple step: Step index and array of channel indices.
+    """
+    i, channels = step
+
+    return [fit_pulse(*_fit_state, i, j) for j in channels]
+
+
 class DataFormat(ABC):
     """
     General data formatting class.
@@ -80,6 +183,9 @@ class DataFormat(ABC):
         'BLOB',
     ]
 
+    # indexed columns, and whether their values are unique
+    indexes = {}
+
     @classmethod
     def verify(cls, structure):
         """
@@ -121,178 +227,404 @@ class DataFormat_v1(DataFormat):
         'detector': 'TEXT',
     }
 
-    def parser(self, raw, callback=None):
+    indexes = {
+        'serial': True,
+        'id': False,
+        'location': False,
+    }
+
+    # bumped whenever parser results change, to invalidate cached results
+    revision = 2
+
+    def scan(self, raw, buf, stats=None):
         """
-        Parser for ADC board data.
-        :param XXX raw: Raw data to be processed.
-        :param XXX callback:
+        Reads the header of a .dat file, and returns its metadata along with
+        an iterator over the decoded events, as (step, event, samples), where
+        samples is a (16, nsample) uint16 array that is reused between events.
+        :param str raw: Path to the .dat file.
+        :param mmap buf: The memory-mapped file.
+        :param ParseStats stats: Records the time spent in every stage, or
+            None.
         """
-        entry = {}
-
-        files = [''] * 4
-        pedes = np.zeros((64, 2))
-        gains = np.zeros((64, 2))
+        if stats is None:
+            stats = ParseStats(enabled=False)
 
         magic = '-' * 32
 
-        with open(raw, 'r') as fp, open(os.devnull, 'w') as fn:
-            metadata = {}
-
-            while (keyval := read_config_line(fp))[0] != magic:
-                metadata[keyval[0]] = keyval[1]
+        metadata = {}
 
-            entry['serial'] = metadata['BOARDID']
-            entry['offset'] = int(metadata['CHANNELMIN'])
-            entry['nstep'] = int(metadata['NUMBEROFSTEPS'])
-            entry['nstep_event'] = int(metadata['EVENTSPERSTEP'])
-            entry['nstep_data'] = int(metadata['DACPERSTEP'])
-            entry['nsample'] = int(metadata['NSAMPLES'])
+        with stats.stage('header'):
+            while (keyval := read_config_line(buf))[0] != magic:
+                # a line without a value, or the end of the file before the
+                # separator line
+                if len(keyval) < 2:
+                    raise DataParseError(raw)
 
-            offset = entry['offset']
-            nstep = entry['nstep']
-            ntrial = entry['nstep_event']
-            nsample = entry['nsample']
+                metadata[keyval[0]] = keyval[1]
 
-            group = offset // 16
+            try:
+                nstep = int(metadata['NUMBEROFSTEPS'])
+                ntrial = int(metadata['EVENTSPERSTEP'])
+                nsample = int(metadata['NSAMPLES'])
 
-            files[group] = raw
+                group = int(metadata['CHANNELMIN']) // 16
+            except (KeyError, ValueError) as e:
+                raise DataParseError(raw) from e
 
-            front = group * nsample
-            back = (3 - group) * nsample
+            # each event: 2 header lines, 4 channel groups of nsample lines,
+            # 2 trailing (empty) lines
+            lines = index_lines(buf)
+            first = np.searchsorted(lines, buf.tell()) + 2 + group * nsample
+            stride = 4 * nsample + 4
 
-            entry['files'] = ', '.join(files)
+        if first + (nstep * ntrial - 1) * stride + nsample >= lines.size:
+            raise DataParseError(raw)
 
-            data = np.zeros((nstep, ntrial, 16, nsample))
+        def events():
+            sample = np.zeros((16, nsample), dtype=np.uint16)
 
             for i in range(nstep):
                 for j in range(ntrial):
-                    # read and discard 2 lines
-                    read_and_discard_lines(fp, 2)
+                    start = first + (i * ntrial + j) * stride
+
+                    with stats.stage('decode'):
+                        block = buf[lines[start]:lines[start + nsample]]
 
-                    # read and discard lines (unused channels)
-                    read_and_discard_lines(fp, front)
+                        try:
+                            dwords = decode_dwords(block).reshape(8, nsample)
+                        except ValueError as e:
+                            raise DataParseError(raw) from e
 
-                    # read and process data array
-                    raw = []
+                        sample[0::2], sample[1::2] = split_dword(dwords)
 
-                    for _ in range(nsample):
-                        line = fp.readline().strip()
-                        raw.extend(filter(None, line.split(' ')))
+                    yield i, j, sample
 
-                    channels = []
+        return metadata, events()
 
-                    for group in zip(*[iter(raw)] * nsample):
-                        channels.extend([[], []])
+    def read(self, raw, callback=None, stream=True, stats=None,
+             dtype=np.float64):
+        """
+        Reads ADC board data from a .dat file or a binary container (see
+        convert), and returns the file metadata along with the mean and
+        standard deviation of each sample over the events of every step,
+        (nstep, 16, nsample). Samples are held as uint16, and summed exactly
+        in int64.
+        :param str raw: Path to the data file.
+        :param function callback: Progress callback, from 0 to 50 (the fits
+            take the second half).
+        :param bool stream: Accumulate per-step sums while decoding, instead of
+            holding every event in memory (.dat files only).
+        :param ParseStats stats: Records the time spent in every stage, or
+            None.
+        :param dtype dtype: Data type of the mean and standard deviation.
+        """
+        if stats is None:
+            stats = ParseStats(enabled=False)
 
-                        for dword in group:
-                            low, high = split_dword(dword)
+        with open(raw, 'rb') as fp:
+            binary = fp.read(len(CONTAINER_MAGIC)) == CONTAINER_MAGIC
 
-                            channels[-2].append(low)
-                            channels[-1].append(high)
+        if binary:
+            with stats.stage('header'):
+                try:
+                    header, data = read_container(raw)
+                except (ValueError, KeyError) as e:
+                    raise DataParseError(raw) from e
 
-                    data[i, j] = channels
+            metadata = header['metadata']
+            nstep, ntrial, _, nsample = data.shape
 
-                    # read and discard lines (unused channels)
-                    read_and_discard_lines(fp, back)
+            total = np.zeros((nstep, 16, nsample), dtype=np.int64)
+            total2 = np.zeros((nstep, 16, nsample), dtype=np.int64)
 
-                    # read and discard 2 lines (unused, empty)
-                    read_and_discard_lines(fp, 2)
+            for i in range(nstep):
+                with stats.stage('statistics'):
+                    total[i] = data[i].sum(axis=0, dtype=np.int64)
+                    total2[i] = np.einsum('tcs,tcs->cs', data[i], data[i],
+                        dtype=np.int64)
 
                 if callback is not None:
                     callback(i * 50 / nstep)
 
-            mean = np.mean(data, axis=1)
-            sigma = np.std(data, axis=1)
+            with stats.stage('statistics'):
+                return metadata, *moments(total, total2, ntrial, dtype)
+
+        with open(raw, 'rb') as fp, \
+                mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            metadata, events = self.scan(raw, buf, stats)
 
-            rels = sigma / mean;
+            nstep = int(metadata['NUMBEROFSTEPS'])
+            ntrial = int(metadata['EVENTSPERSTEP'])
+            nsample = int(metadata['NSAMPLES'])
 
-            x = np.arange(nstep)
-            y = np.zeros((16, nstep))
+            if stream:
+                total = np.zeros((nstep, 16, nsample), dtype=np.int64)
+                total2 = np.zeros((nstep, 16, nsample), dtype=np.int64)
+            else:
+                data = np.zeros((nstep, ntrial, 16, nsample), dtype=np.uint16)
 
-            def min_form(x, *args):
-                return -powerlaw_doubleexp(x, *args)
+            for i, j, sample in events:
+                with stats.stage('statistics'):
+                    if stream:
+                        total[i] += sample
+                        total2[i] += np.square(sample, dtype=np.int64)
+                    else:
+                        data[i, j] = sample
 
-            def display_fit_error(message):
-                print(' [!] ERROR: [pulse: {}, channel: {}]'.format(i, j))
-                print('     {}'.format(message))
+                if callback is not None and j == ntrial - 1:
+                    callback(i * 50 / nstep)
 
-            sys_stdout = sys.stdout
-            sys.stdout = fn
+        with stats.stage('statistics'):
+            if not stream:
+                total = data.sum(axis=1, dtype=np.int64)
+                total2 = np.einsum('itcs,itcs->ics', data, data,
+                    dtype=np.int64)
 
-            errc = np.zeros((16, nstep), dtype=np.int32)
+            return metadata, *moments(total, total2, ntrial, dtype)
 
-            for i in range(nstep):
-                for j in range(0, 16):
-                    if np.any(rels[i,j,:] > 0.1):
-                        err = ParseError.SIGMA
-                        display_fit_error(errm[err])
-                        errc[j,i] = int(err)
-                        continue
-
-                    if np.any(sigma == 0) and np.any(mean == 16384):
-                        err = ParseError.PSAT
-                        display_fit_error(errm[err])
-                        errc[j,i] = int(err)
-                        continue
-
-                    if np.any(sigma == 0) and np.any(mean == 0):
-                        err = ParseError.PZERO
-                        display_fit_error(errm[err])
-                        errc[j,i] = int(err)
-                        continue
-
-                    try:
-                        popt, pcov = fit_signal(mean, sigma, nsample, i, j,
-                            method='dogbox')
-                        xmin = fmin(min_form, 5, args=tuple(popt))
-
-                        y[j][i] = powerlaw_doubleexp(xmin, *popt)
-                    except (ValueError, np.linalg.LinAlgError):
-                        err = ParseError.FIT
-                        display_fit_error(errm[err])
-                        errc[j,i] = int(err)
-                        pass
-                    except RuntimeError:
-                        pass
+    def convert(self, raw, path, callback=None):
+        """
+        Converts a .dat file into a binary container, holding the file
+        metadata and the decoded samples of its channel group as a
+        memory-mappable uint16 array, (nstep, ntrial, 16, nsample).
+        :param str raw: Path to the .dat file.
+        :param str path: Path to the binary container.
+        :param function callback: Progress callback, from 0 to 100.
+        """
+        with open(raw, 'rb') as fp, \
+                mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            metadata, events = self.scan(raw, buf)
 
-                if callback is not None:
-                    callback(50 + (i * 50 / nstep))
+            nstep = int(metadata['NUMBEROFSTEPS'])
+            ntrial = int(metadata['EVENTSPERSTEP'])
+            nsample = int(metadata['NSAMPLES'])
+
+            data = write_container(path, {'metadata': metadata},
+                (nstep, ntrial, 16, nsample))
+
+            for i, j, sample in events:
+                data[i, j] = sample
+
+                if callback is not None and j == ntrial - 1:
+                    callback(i * 100 / nstep)
+
+            data.flush()
+
+            del data
+
+    def parser(self, raw, callback=None, stage=ParseStage.CALIBRATE,
+               stream=True, fitter='batch', workers=None, seed='default',
+               stats=None, dtype='float64', template=None):
+        """
+        Parser for ADC board data. Stages short of a full calibration return
+        None for the results they skip, and an entry holding only the file
+        metadata.
+        :param XXX raw: Raw data to be processed, either a .dat file or a
+            binary container (see convert).
+        :param XXX callback:
+        :param ParseStage stage: How far to process the data.
+        :param bool stream: Accumulate per-step sums while decoding, instead of
+            holding every event in memory.
+        :param str fitter: Pulse fitter, either 'batch' (all pulses at once),
+            'scipy' (one curve_fit per pulse) or 'template' (a linear fit of
+            a pedestal and a scaled pulse shape template, see fit_template).
+        :param int workers: Number of worker processes for the 'scipy' pulse
+            fits.
+        :param str seed: Initial parameters of the 'batch' pulse fits, either
+            'default' (the same for every pulse) or 'warm' (the converged
+            parameters of the previous step, see fit_signal_warm).
+        :param ParseStats stats: If not None, records the time, calls, memory
+            and fit counters of every stage of this run (in this process).
+        :param str dtype: Data type of the returned mean and sigma, 'float64'
+            or 'float32' (the pulse fits always run in float64).
+        :param array template: Pulse shape templates of the 'template' fitter,
+            (16, nsample), or None to build them from the largest pulse of
+            every channel (see make_template).
+        """
+        if stats is None:
+            stats = ParseStats(enabled=False)
+
+        try:
+            with stats.stage('total'):
+                return self._parse(raw, callback, stage, stream, fitter,
+                    workers, seed, stats, np.dtype(dtype), template)
+        finally:
+            stats.record(raw)
+
+    def _parse(self, raw, callback, stage, stream, fitter, workers, seed,
+               stats, dtype, template):
+        """
+        Parser for ADC board data (see parser).
+        """
+        metadata, mean, sigma = self.read(raw, callback, stream, stats, dtype)
+
+        entry = self.describe(raw, metadata)
 
-            sys.stdout = sys_stdout
+        nstep = entry['nstep']
+        nsample = entry['nsample']
 
-            pval = [1500, 375]
-            bmin = [ 500, 275]
-            bmax = [2500, 475]
+        if stage < ParseStage.PULSE:
+            return entry, mean, sigma, None, None, None
 
-            pars = np.zeros((0, 2))
-            errs = np.zeros((0, 2))
+        y = np.zeros((16, nstep))
 
-            for i in range(y.shape[0]):
-                i_valid = y[i,2:] != 0
+        def display_fit_error(message):
+            logger.debug('[pulse: %d, channel: %d] %s', i, j, message)
 
-                if np.count_nonzero(i_valid) > 1:
-                    x_valid = x[2:][i_valid]
-                    y_valid = y[i,2:][i_valid]
+        with stats.stage('screen'):
+            errc = screen_pulses(mean, sigma)
+
+        for j, i in np.argwhere(errc != ParseError.NONE):
+            display_fit_error(errm[ParseError(errc[j,i])])
+
+        steps = [
+            (i, np.flatnonzero(errc[:,i] == ParseError.NONE))
+            for i in range(nstep)
+        ]
+
+        vectorized = fitter in ('batch', 'template')
+
+        if vectorized:
+            executor = None
+
+            valid = errc.T == ParseError.NONE
+            index = np.nonzero(valid)
+
+        if fitter == 'template':
+            if template is None:
+                with stats.stage('template'):
+                    template = make_template(mean, sigma, valid)
+
+            with stats.stage('pulse_fit'):
+                pedestal, amplitude = fit_template(mean, template)
+
+            stats.count('pulse_fit', fits=int(index[0].size))
+
+            maxima = (pedestal + amplitude)[index]
+            ierr = np.full(maxima.shape, ParseError.NONE, dtype=np.int32)
+        elif fitter == 'batch':
+            with stats.stage('pulse_fit'):
+                if seed == 'warm':
+                    popt, pcov, ierr, info = fit_signal_warm(mean, sigma,
+                        valid)
+                    popt, ierr = popt[index], ierr[index]
+                    info = { k: v[index] for k, v in info.items() }
                 else:
-                    x_valid = x[2:]
-                    y_valid = y[i,2:]
+                    popt, pcov, ierr, info = fit_signal_batch(mean[index],
+                        sigma[index], full_output=True)
+
+            stats.count('pulse_fit', fits=int(ierr.size),
+                **{ k: int(np.sum(v)) for k, v in info.items() })
+
+            with stats.stage('peak_find'):
+                maxima = find_pulse_maximum(popt, nsample)
+
+        if vectorized:
+            ierr[~np.isfinite(maxima)] = ParseError.FIT
+            maxima[ierr != ParseError.NONE] = 0.
+
+            fits = zip(maxima, map(ParseError, ierr))
+            results = (
+                [next(fits) for _ in channels] for i, channels in steps
+            )
+        elif workers is not None and workers > 1:
+            executor = ProcessPoolExecutor(workers,
+                initializer=_init_fit_worker,
+                initargs=(mean, sigma, nsample))
+            results = executor.map(_fit_step, steps)
+        else:
+            executor = None
+            results = (
+                [fit_pulse(mean, sigma, nsample, i, j) for j in channels]
+                for i, channels in steps
+            )
+
+        try:
+            with stats.stage('collect' if vectorized else 'pulse_fit'):
+                for (i, channels), result in zip(steps, results):
+                    for j, (value, err) in zip(channels, result):
+                        y[j][i] = value
+
+                        if err is not ParseError.NONE:
+                            display_fit_error(errm[err])
+                            errc[j,i] = int(err)
+
+                    if callback is not None:
+                        callback(50 + (i * 50 / nstep))
+        finally:
+            if executor is not None:
+                executor.shutdown()
+
+        if not vectorized:
+            stats.count('pulse_fit', fits=sum(c.size for _, c in steps))
+
+        if stage < ParseStage.CALIBRATE:
+            return entry, mean, sigma, y, None, None
+
+        pars, errs = self.calibrate(entry, y, errc, stats)
+
+        return entry, mean, sigma, y, pars, errs
+
+    def describe(self, raw, metadata):
+        """
+        Returns the database entry of a data file, holding only its metadata.
+        :param str raw: Path to the data file.
+        :param dict metadata: The file metadata (header).
+        """
+        entry = {}
+
+        entry['serial'] = metadata['BOARDID']
+        entry['offset'] = int(metadata['CHANNELMIN'])
+        entry['nstep'] = int(metadata['NUMBEROFSTEPS'])
+        entry['nstep_event'] = int(metadata['EVENTSPERSTEP'])
+        entry['nstep_data'] = int(metadata['DACPERSTEP'])
+        entry['nsample'] = int(metadata['NSAMPLES'])
+
+        files = [''] * 4
+        files[entry['offset'] // 16] = raw
+
+        entry['files'] = ', '.join(files)
+
+        return entry
+
+    def calibrate(self, entry, y, errc, stats=None):
+        """
+        Fits the pedestal and gain of every channel to the pulse maxima, and
+        completes the database entry with the results and parser errors.
+        Returns the parameters and their errors, (16, 2).
+        :param dict entry: The database entry (see describe).
+        :param array y: Pulse maxima, (16, nstep). Zeros are ignored.
+        :param array errc: Parser error codes, (16, nstep).
+        :param ParseStats stats: Records the time spent, or None.
+        """
+        if stats is None:
+            stats = ParseStats(enabled=False)
+
+        pedes = np.zeros((64, 2))
+        gains = np.zeros((64, 2))
+
+        x = np.arange(y.shape[1])
+
+        bmin = [ 500, 275]
+        bmax = [2500, 475]
 
-                popt, pcov = curve_fit(linear, x_valid, y_valid, p0=pval,
-                    bounds=(bmin, bmax))
+        with stats.stage('linear_fit'):
+            # channels with at most one valid step are fitted over every step
+            i_valid = y[:,2:] != 0
+            i_valid[np.count_nonzero(i_valid, axis=1) <= 1] = True
 
-                pars = np.vstack((pars, popt))
-                errs = np.vstack((errs, np.sqrt(np.diag(pcov))))
+            pars, errs = fit_linear_batch(x[2:], y[:,2:], i_valid, bmin, bmax)
 
-            i_min = offset
-            i_max = offset + 16
+        i_min = entry['offset']
+        i_max = i_min + 16
 
-            pedes[i_min:i_max,0] = pars[:,0]
-            pedes[i_min:i_max,1] = errs[:,0]
-            gains[i_min:i_max,0] = pars[:,1]
-            gains[i_min:i_max,1] = errs[:,1]
+        pedes[i_min:i_max,0] = pars[:,0]
+        pedes[i_min:i_max,1] = errs[:,0]
+        gains[i_min:i_max,0] = pars[:,1]
+        gains[i_min:i_max,1] = errs[:,1]
 
-            entry['pedes'] = np.array_repr(pedes)
-            entry['gains'] = np.array_repr(gains)
+        entry['pedes'] = np.array_repr(pedes)
+        entry['gains'] = np.array_repr(gains)
 
         timestamp = datetime.now().strftime('%y%m%d-%H:%M:%S')
 
@@ -313,7 +645,269 @@ class DataFormat_v1(DataFormat):
         entry['slot'] = ''
         entry['detector'] = ''
 
-        return entry, mean, sigma, y, pars, errs
+        return pars, errs
+
+
+class DataFollower:
+    """
+    Parses an ADC board .dat file while it is being written, one step at a
+    time: each step is decoded and its pulses are fitted as soon as all of
+    its events are in the file. The partial mean, sigma and pulse maxima (y)
+    of the completed steps are kept as attributes, and the calibration is
+    ready as soon as the last step is complete.
+    """
+    magic = b'-' * 32
+
+    def __init__(self, raw, seed='default'):
+        """
+        Initializes a DataFollower object.
+        :param str raw: Path to the .dat file.
+        :param str seed: Initial parameters of the pulse fits, either 'default'
+            or 'warm' (the converged parameters of the previous step, with the
+            amplitude scaled by the change of the pulse height).
+        """
+        self.raw = raw
+        self.seed = seed
+        self.parser = DataFormat_v1()
+
+        self.entry = None
+        self.nstep = None
+        self.ntrial = None
+        self.nsample = None
+        self.group = None
+        self.steps = 0
+
+        self.mean = None
+        self.sigma = None
+        self.y = None
+        self.errc = None
+
+        # unparsed text, from the beginning of the next step
+        self.position = 0
+        self.text = b''
+
+        # converged parameters and pulse height of the last fitted step
+        self.prev = None
+        self.height = None
+
+    @property
+    def complete(self):
+        """
+        Whether every step has been parsed.
+        """
+        return self.nstep is not None and self.steps == self.nstep
+
+    def header(self):
+        """
+        Parses the file header, once the separator line has been written.
+        Returns whether the header is complete.
+        """
+        lines = self.text.split(b'\n')
+
+        for n, line in enumerate(lines[:-1]):
+            if line.strip() == self.magic:
+                break
+        else:
+            return False
+
+        metadata = {}
+
+        for line in lines[:n]:
+            keyval = read_config_line(io.BytesIO(line))
+            metadata[keyval[0]] = keyval[1]
+
+        try:
+            self.entry = self.parser.describe(self.raw, metadata)
+        except (KeyError, ValueError) as e:
+            raise DataParseError(self.raw) from e
+
+        self.nstep = self.entry['nstep']
+        self.ntrial = self.entry['nstep_event']
+        self.nsample = self.entry['nsample']
+        self.group = self.entry['offset'] // 16
+
+        self.mean = np.zeros((self.nstep, 16, self.nsample))
+        self.sigma = np.zeros((self.nstep, 16, self.nsample))
+        self.y = np.zeros((16, self.nstep))
+        self.errc = np.zeros((16, self.nstep), dtype=np.int32)
+
+        self.prev = np.full((16, 7), np.nan)
+        self.height = np.full(16, np.nan)
+
+        self.text = b'\n'.join(lines[n + 1:])
+
+        return True
+
+    def update(self):
+        """
+        Reads the text appended to the file since the last update, and parses
+        every step that is complete. Returns the indices of the new steps.
+        """
+        with open(self.raw, 'rb') as fp:
+            fp.seek(self.position)
+            data = fp.read()
+
+        # only complete lines
+        end = data.rfind(b'\n') + 1
+
+        self.position += end
+        self.text += data[:end]
+
+        if self.entry is None and not self.header():
+            return []
+
+        # each event: 2 header lines, 4 channel groups of nsample lines,
+        # 2 trailing (empty) lines
+        stride = 4 * self.nsample + 4
+        first = 2 + self.group * self.nsample
+
+        # the last step is complete once the channel group of its last event
+        # is written, the others once every line of the step is
+        last = first + (self.ntrial - 1) * stride + self.nsample
+        full = self.ntrial * stride
+
+        # offsets of the line starts, and of the end of the text
+        lines = index_lines(self.text)
+        done = []
+
+        while not self.complete:
+            need = last if self.steps == self.nstep - 1 else full
+
+            if not self.text or lines.size - 1 < need:
+                break
+
+            start = lines[first + np.arange(self.ntrial) * stride]
+            stop = lines[first + np.arange(self.ntrial) * stride + self.nsample]
+
+            self.step(self.steps, [self.text[a:b] for a, b in zip(start, stop)])
+
+            done.append(self.steps)
+            self.steps += 1
+
+            if self.complete:
+                self.text = b''
+            else:
+                self.text = self.text[lines[full]:]
+                lines = lines[full:] - lines[full]
+
+        return done
+
+    def step(self, i, blocks):
+        """
+        Decodes the events of a step and fits its pulses.
+        :param int i: The step index.
+        :param list blocks: The channel group text of every event.
+        """
+        total = np.zeros((16, self.nsample), dtype=np.int64)
+        total2 = np.zeros((16, self.nsample), dtype=np.int64)
+        sample = np.zeros((16, self.nsample), dtype=np.uint16)
+
+        for block in blocks:
+            try:
+                dwords = decode_dwords(block).reshape(8, self.nsample)
+            except ValueError as e:
+                raise DataParseError(self.raw) from e
+
+            sample[0::2], sample[1::2] = split_dword(dwords)
+
+            total += sample
+            total2 += np.square(sample, dtype=np.int64)
+
+        mean, sigma = moments(total[None], total2[None], self.ntrial)
+
+        self.mean[i], self.sigma[i] = mean[0], sigma[0]
+
+        self.errc[:,i] = screen_pulses(mean, sigma)[:,0]
+
+        channels = np.flatnonzero(self.errc[:,i] == ParseError.NONE)
+        if not channels.size:
+            return
+
+        with np.errstate(all='ignore'):
+            height = np.amax(mean[0,channels], axis=-1) - mean[0,channels,0]
+            scale = height / self.height[channels]
+
+        seed = self.prev[channels].copy()
+        seed[:,0] *= scale
+
+        warm = (
+            (self.seed == 'warm')
+            & np.all(np.isfinite(seed), axis=1) & (scale > 0)
+        )
+        seed[~warm] = np.nan
+
+        popt, _, ierr, info = fit_signal_batch(mean[0,channels],
+            sigma[0,channels], p0=seed, full_output=True)
+
+        retry = warm & ~info['success']
+        if np.any(retry):
+            popt[retry], _, ierr[retry], info_retry = fit_signal_batch(
+                mean[0,channels[retry]], sigma[0,channels[retry]],
+                full_output=True)
+            info['success'][retry] = info_retry['success']
+
+        maxima = find_pulse_maximum(popt, self.nsample)
+
+        ierr[~np.isfinite(maxima)] = ParseError.FIT
+        maxima[ierr != ParseError.NONE] = 0.
+
+        self.y[channels,i] = maxima
+        self.errc[channels,i] = ierr
+
+        # pulses buried in the noise do not constrain the shape
+        ok = (
+            info['success'] & (ierr == ParseError.NONE)
+            & (height > 10. * np.amax(sigma[0,channels], axis=-1))
+        )
+        self.prev[channels[ok]] = popt[ok]
+        self.height[channels[ok]] = height[ok]
+
+    def result(self):
+        """
+        Returns the parser results (see DataFormat_v1.parser) of the steps
+        parsed so far. Missing steps are left at zero (and ignored by the
+        pedestal and gain fits).
+        """
+        if self.entry is None:
+            return None
+
+        entry = dict(self.entry)
+
+        pars, errs = self.parser.calibrate(entry, self.y,
+            self.errc[:,:max(self.steps, 1)])
+
+        return entry, self.mean, self.sigma, self.y, pars, errs
+
+    def follow(self, poll=1., timeout=60., callback=None):
+        """
+        Follows the file until its last step is parsed, and yields the indices
+        of the steps as they are completed. Stops early (with the file still
+        incomplete) if the file does not grow for longer than the timeout.
+        :param float poll: Time between updates, in seconds.
+        :param float timeout: Time without new data after which to stop, in
+            seconds, or None to wait forever.
+        :param function callback: Progress callback, from 0 to 100.
+        """
+        idle = time.monotonic()
+
+        while not self.complete:
+            position = self.position
+
+            for i in self.update():
+                if callback is not None:
+                    callback((i + 1) * 100 / self.nstep)
+
+                yield i
+
+            if self.complete:
+                break
+
+            if self.position != position:
+                idle = time.monotonic()
+            elif timeout is not None and time.monotonic() - idle > timeout:
+                break
+
+            time.sleep(poll)
 
 
 class DataFormat_v2(DataFormat):
@@ -335,6 +929,12 @@ class DataFormat_v2(DataFormat):
         'detector': 'TEXT',
     }
 
+    indexes = {
+        'serial': True,
+        'id': False,
+        'location': False,
+    }
+
     def parser(self, raw):
         """
         Parser for XMIT board data. No data is processed.
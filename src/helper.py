@@ -1,12 +1,42 @@
 # pylint: disable=missing-docstring,invalid-name
 
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from datetime import datetime
 import operator
+import os
+import sqlite3
 
+import numpy as np
+
+from profiling import ParseStats
 from squash import Squash
 
 import formats
 
 
+def _parse(version, raw, profile=None, catch=False, **kwargs):
+    """
+    Parses a raw data file, in this or a worker process. Returns the parser
+    result and None, or None and the error message if the file could not be
+    parsed and errors are caught.
+    :param str version: The database version.
+    :param str raw: Path to the raw data file.
+    :param str profile: Path to a JSON lines file for parser statistics, or
+        None.
+    :param bool catch: Return parser errors instead of raising them.
+    """
+    if profile is not None:
+        kwargs['stats'] = ParseStats(log=profile)
+
+    try:
+        return formats.factory[version]().parser(raw, **kwargs), None
+    except Exception as e: # pylint: disable=broad-except
+        if not catch:
+            raise
+
+        return None, '{}: {}'.format(type(e).__name__, e)
+
+
 class SquashHelper:
     """
     Creates a helper object for interfacing between the tkinter GUI and the
@@ -15,18 +45,23 @@ class SquashHelper:
     squash = None
     path = None
     table = None
+    cache = None
 
-    def __init__(self, path, table='data', version='auto'):
+    def __init__(self, path, table='data', version='auto', cache=None,
+                 journal=None):
         """
         Initializes a SquashHelper object that interfaces with a Squash
         database control object.
         :param str path: The system path to the SQLite database.
         :param str table: The data table within the database. 
         :param str version: The database version. XXX
+        :param ParseCache cache: Cache for parser results, or None.
+        :param str journal: The journal mode (see Squash.set_journal).
         """
-        self.squash = Squash(path)
+        self.squash = Squash(path, journal)
         self.path = path
         self.table = table
+        self.cache = cache
 
         def _set(self, version):
             """
@@ -56,6 +91,7 @@ class SquashHelper:
         self.squash = None
         self.path = None
         self.table = None
+        self.cache = None
         self.version = None
         self.object = None
 
@@ -65,14 +101,14 @@ class SquashHelper:
         :param str path:  The system path to the SQLite database.
         :param str table: The data table within the database.
         """
-        info = self.squash.query('pragma table_info({})'.format(table))
+        columns = self.squash.columns(table)
 
         versions = [
             k
             for k, v in formats.factory.items()
             if (
-                len(info) == len(v.structure)
-                and all(x[1] in v.structure for x in info)
+                len(columns) == len(v.structure)
+                and all(x in v.structure for x in columns)
             )
         ]
 
@@ -91,6 +127,46 @@ class SquashHelper:
             raise formats.DataTypeError(self.version)
 
         self.squash.insert_table(structure, self.table)
+        self.migrate()
+
+    def index(self, column):
+        """
+        Returns the name of the index of a column.
+        :param str column: The indexed column.
+        """
+        return '{}_{}'.format(self.table, column)
+
+    def migrate(self):
+        """
+        Builds the indexes declared by the database format that do not exist
+        yet. Returns the names of the indexes that could not be built, such as
+        a unique index over duplicate values, or of a read-only database.
+        """
+        existing = self.squash.indexes(self.table)
+        failed = []
+
+        for column, unique in self.object.indexes.items():
+            name = self.index(column)
+            if name in existing:
+                continue
+
+            try:
+                self.squash.insert_index(name, (column,), unique, self.table)
+            except sqlite3.Error:
+                failed.append(name)
+
+        return failed
+
+    def explain(self, where=None):
+        """
+        Returns the query plan of a selection (see select), e.g. to check that
+        it searches an index rather than scanning the table.
+        :param dict where: Column names and values to match.
+        """
+        keys, values = Squash.bind(where)
+        query = Squash.statement('SELECT', self.table, ('*',), keys)
+
+        return self.squash.explain(query, values)
 
     def label(self, data):
         """
@@ -103,31 +179,283 @@ class SquashHelper:
 
         return { v: data[i] for i, v in enumerate(structure.keys()) }
 
-    def parse(self, raw, **kwargs):
+    def key(self, raw, options):
+        """
+        Returns the parse cache key for a raw data file, or None if there is
+        no parse cache.
+        :param str raw: Path to the raw data file.
+        :param dict options: Parser options.
+        """
+        if self.cache is None:
+            return None
+
+        # options that do not change the result
+        options = {
+            k: v for k, v in options.items()
+            if k not in ('callback', 'workers', 'stats')
+        }
+
+        return self.cache.key(raw, self.object, **options)
+
+    def parse(self, raw, refresh=False, **kwargs):
         """
-        Parses inputs.
+        Parses inputs. Results are looked up in (and stored to) the parse
+        cache, if there is one.
         :param raw: Raw input data to be parsed.
+        :param bool refresh: Parse again even if a cached result exists.
+        """
+        key = self.key(raw, kwargs)
+
+        if key is not None and not refresh:
+            if (result := self.cache.load(key)) is not None:
+                return result
+
+        result = self.object.parser(raw, **kwargs)
+
+        if key is not None:
+            self.cache.store(key, result)
+
+        return result
+
+    def parse_board(self, entry, groups=range(4), callback=None,
+                    refresh=False, workers=4, **kwargs):
+        """
+        Parses the channel group data files of a board concurrently, and
+        combines the results into 64-channel arrays: mean and sigma (nstep, 64,
+        nsample), y (64, nstep), pars and errs (64, 2). Channels of groups that
+        were not parsed are left at zero. Returns None if there is no file to
+        parse.
+        :param dict entry: The board database entry (see label).
+        :param iterable groups: Channel groups (0 to 3) to parse.
+        :param function callback: Progress callback, from 0 to 100.
+        :param bool refresh: Parse again even if cached results exist.
+        :param int workers: Maximum number of worker processes.
+        """
+        files = entry['files'].split(', ')[:4]
+        root = os.path.dirname(self.path)
+
+        jobs = {
+            g: os.path.join(root, files[g])
+            for g in groups if g < len(files) and files[g]
+        }
+
+        if not jobs:
+            return None
+
+        results, _ = self.parse_many(list(jobs.values()), workers=workers,
+            refresh=refresh, callback=callback, **kwargs)
+
+        return self.combine([results[jobs[g]] for g in sorted(jobs)])
+
+    def parse_many(self, files, workers=4, refresh=False, callback=None,
+                   profile=None, catch=False, **kwargs):
+        """
+        Parses many raw data files concurrently, in worker processes. Results
+        are looked up in (and stored to) the parse cache, if there is one.
+        Returns the parser results, and the error messages of the files that
+        could not be parsed (if errors are caught), as dicts keyed by path.
+        :param list files: Paths to the raw data files.
+        :param int workers: Maximum number of worker processes.
+        :param bool refresh: Parse again even if cached results exist.
+        :param function callback: Progress callback, from 0 to 100.
+        :param str profile: Path to a JSON lines file, to which the parser
+            statistics of every file are appended (see ParseStats), or None.
+        :param bool catch: Report the files that could not be parsed instead
+            of raising the parser error.
+        """
+        keys = { raw: self.key(raw, kwargs) for raw in files }
+        results = {}
+        errors = {}
+
+        for raw, key in keys.items():
+            if key is not None and not refresh:
+                if (result := self.cache.load(key)) is not None:
+                    results[raw] = result
+
+        def done(raw, result, error):
+            if error is not None:
+                errors[raw] = error
+            else:
+                results[raw] = result
+
+                if keys[raw] is not None:
+                    self.cache.store(keys[raw], result)
+
+            if callback is not None:
+                callback((len(results) + len(errors)) * 100 / len(keys))
+
+        pending = [raw for raw in keys if raw not in results]
+        options = dict(profile=profile, catch=catch, **kwargs)
+
+        if len(pending) > 1 and workers is not None and workers > 1:
+            with ProcessPoolExecutor(min(workers, len(pending))) as executor:
+                futures = {
+                    executor.submit(_parse, self.version, raw, **options): raw
+                    for raw in pending
+                }
+
+                for future in as_completed(futures):
+                    done(futures[future], *future.result())
+        else:
+            for raw in pending:
+                done(raw, *_parse(self.version, raw, **options))
+
+        return results, errors
+
+    def combine(self, results):
+        """
+        Combines the parser results of the channel group files of a board
+        into 64-channel arrays (see parse_board).
+        :param list results: Parser results, one per channel group file.
+        """
+        entry = dict(results[0][0])
+        nstep, _, nsample = results[0][1].shape
+
+        def _zeros(shape, present):
+            return np.zeros(shape) if present else None
+
+        mean = np.zeros((nstep, 64, nsample))
+        sigma = np.zeros((nstep, 64, nsample))
+        y = _zeros((64, nstep), results[0][3] is not None)
+        pars = _zeros((64, 2), results[0][4] is not None)
+        errs = _zeros((64, 2), results[0][5] is not None)
+
+        files = [''] * 4
+        comments = []
+
+        for e, m, s, _y, _p, _e in results:
+            group = e['offset'] // 16
+            c = slice(e['offset'], e['offset'] + 16)
+
+            mean[:,c] = m
+            sigma[:,c] = s
+
+            for total, part in ((y, _y), (pars, _p), (errs, _e)):
+                if total is not None:
+                    total[c] = part
+
+            files[group] = e['files'].split(', ')[group]
+
+            if e.get('comment'):
+                comments.append(e['comment'])
+
+        entry['offset'] = 0
+        entry['files'] = ', '.join(files)
+
+        if pars is not None:
+            entry['pedes'] = np.array_repr(np.column_stack((pars[:,0], errs[:,0])))
+            entry['gains'] = np.array_repr(np.column_stack((pars[:,1], errs[:,1])))
+            entry['comment'] = '; '.join(comments)
+
+        return entry, mean, sigma, y, pars, errs
+
+    def merge(self, data, entry, user):
+        """
+        Merges the parsed entry of a channel group data file into the existing
+        database entry of the board, and returns the columns to update.
+        :param dict data: The existing database entry (see label).
+        :param dict entry: The parsed entry.
+        :param str user: The user responsible for the update.
         """
-        return self.object.parser(raw, **kwargs)
+        entry = dict(entry)
+
+        group = entry['offset'] // 16
+
+        files = data['files'].split(', ')
+        files[group] = os.path.relpath(
+            entry['files'].split(', ')[group],
+            os.path.dirname(self.path)
+        )
+
+        i_min = group * 16
+        i_max = i_min + 16
+
+        # the parsed entry holds the parse time, which is that of the first
+        # parse for cached results: the history records the update time
+        timestamp = datetime.now().strftime('%y%m%d-%H:%M:%S')
+        history = 'UPDATE: ({}:{}) [{}] <{}>'.format(
+            i_min, i_max - 1, timestamp, user)
+
+        def _array(text):
+            return eval(text.replace('\\n', ''), {'array': np.array})
+
+        pedes = _array(data['pedes'])
+        gains = _array(data['gains'])
+        pedes[i_min:i_max] = _array(entry['pedes'])[i_min:i_max]
+        gains[i_min:i_max] = _array(entry['gains'])[i_min:i_max]
+
+        entry['files'] = ', '.join(files)
+        entry['pedes'] = np.array_repr(pedes)
+        entry['gains'] = np.array_repr(gains)
+
+        entry['location'] = data['location']
+        entry['history'] = ', '.join([data['history'], history])
+        entry['status'] = data['status']
+        entry['rack'] = data['rack']
+        entry['crate'] = data['crate']
+        entry['slot'] = data['slot']
+        entry['detector'] = data['detector']
+
+        if entry['comment']:
+            comments = [x for x in data['comment'].split('; ') if x]
+            comments.extend(entry['comment'].split('; '))
+            comments.append(
+                '{} parser errors ({}:{}) <{}>'.format(
+                    len(entry['comment'].split('; ')), i_min, i_max - 1, user
+                )
+            )
+            entry['comment'] = '; '.join(comments)
+        else:
+            entry['comment'] = data['comment']
+
+        return entry
 
     def insert(self, columns, data):
         """
         :param XXX columns:
         :param XXX data:
         """
-        return self.squash.insert_entry(columns, data, self.table)
+        return self.squash.insert_values(dict(zip(columns, data)), self.table)
+
+    def transaction(self):
+        """
+        Returns a context manager that commits the inserts and updates made
+        within it at once (see Squash.transaction).
+        """
+        return self.squash.transaction()
 
-    def update(self, columns, data, condition):
+    def update_many(self, columns, data, key='serial'):
+        """
+        Updates many database entries in a single transaction.
+        :param list/tuple columns: List of data categories to update.
+        :param list data: List of rows, each holding the values of the columns
+            followed by the value of the key column identifying the entry.
+        :param str key: The column identifying the entries.
+        """
+        return self.squash.update_entries(columns, data, key, self.table)
+
+    def update(self, columns, data, condition='', where=None):
         """
         Updates a database entry.
         :param list/tuple columns: List of data categories to insert.
         :param list data: List of datapoints to insert, corresponding to categories.
         :param str condition: Conditional statements for the query. XXX
+        :param dict where: Column names and values identifying the entries,
+            as bound parameters (instead of condition).
         """
+        if where is not None:
+            return self.squash.update_values(dict(zip(columns, data)), where,
+                self.table)
+
         return self.squash.update_entry(columns, data, condition, self.table)
 
-    def select(self, condition=''):
+    def select(self, condition='', where=None):
         """
         :param str condition: Conditional statements for the selection query. XXX
+        :param dict where: Column names and values to match, as bound
+            parameters (instead of condition).
         """
+        if where is not None:
+            return self.squash.select_values(where, table=self.table)
+
         return self.squash.select_entry('*', condition, self.table)
@@ -0,0 +1,154 @@
+# pylint: disable=missing-docstring,invalid-name
+
+import argparse
+import getpass
+import glob
+import os
+import time
+
+import numpy as np
+
+from cache import ParseCache
+from helper import SquashHelper
+
+import formats
+
+
+def ingest(path, files, user, workers=4, cache=None, refresh=False,
+           log=print, profile=None):
+    """
+    Parses many raw data files and merges the results into the existing
+    database entries of their boards, in a single transaction. Files are
+    parsed concurrently; database writes happen in this process only.
+    Returns a dict of counters.
+    :param str path: The system path to the SQLite database.
+    :param list files: Paths to the raw data files.
+    :param str user: The user responsible for the update.
+    :param int workers: Maximum number of worker processes.
+    :param ParseCache cache: Cache for parser results, or None.
+    :param bool refresh: Parse again even if cached results exist.
+    :param function log: Function printing progress messages.
+    :param str profile: Path to a JSON lines file, to which the parser
+        statistics of every file are appended (see ParseStats), or None.
+    """
+    helper = SquashHelper(path, cache=cache)
+
+    if not isinstance(helper.object, formats.DataFormat_v1):
+        helper.close()
+        raise formats.DataTypeError(helper.version)
+
+    stats = { 'files': len(files), 'parsed': 0, 'failed': 0, 'unknown': 0,
+              'updated': 0, 'fits': 0 }
+
+    start = time.perf_counter()
+
+    results, errors = helper.parse_many(files, workers=workers,
+        refresh=refresh, profile=profile, catch=True)
+
+    for raw, error in errors.items():
+        stats['failed'] += 1
+        log('failed: {} ({})'.format(raw, error))
+
+    stats['parsed'] = len(results)
+
+    parsed = time.perf_counter()
+
+    # group the results by board, in file order
+    boards = {}
+
+    for raw in files:
+        if raw in results:
+            boards.setdefault(results[raw][0]['serial'], []).append(raw)
+
+    rows = {}
+
+    if boards:
+        for x in helper.select(where={'serial': list(boards)}):
+            data = helper.label(x)
+            rows[data['serial']] = data
+
+    columns = None
+    update = []
+
+    for serial, raws in boards.items():
+        if serial not in rows:
+            stats['unknown'] += len(raws)
+            log('unknown board: {} ({})'.format(serial, ', '.join(raws)))
+            continue
+
+        data = rows[serial]
+
+        for raw in raws:
+            entry, _, _, y, _, _ = results[raw]
+
+            entry = helper.merge(data, entry, user)
+            data = { **data, **entry }
+
+            stats['fits'] += np.count_nonzero(y)
+            stats['updated'] += 1
+
+        columns = columns or list(entry.keys())
+        update.append([data[k] for k in columns] + [serial])
+
+    if update:
+        helper.update_many(columns, update)
+
+    helper.close()
+
+    end = time.perf_counter()
+
+    stats['parse_time'] = parsed - start
+    stats['total_time'] = end - start
+
+    return stats
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description='Parses ADC raw data files and merges the results into '
+                    'the existing board entries of a squash database.'
+    )
+    parser.add_argument('database', help='path to the SQLite database')
+    parser.add_argument('directory', help='directory of raw data files')
+    parser.add_argument('--pattern', default='*.dat',
+                        help='glob pattern of raw data files (default: %(default)s)')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='number of parser processes (default: %(default)s)')
+    parser.add_argument('--user', default=getpass.getuser(),
+                        help='user recorded in the history (default: %(default)s)')
+    parser.add_argument('--cache', default=None,
+                        help='parse cache directory (default: no cache)')
+    parser.add_argument('--refresh', action='store_true',
+                        help='parse again even if cached results exist')
+    parser.add_argument('--profile', default=None,
+                        help='JSON lines file for per-stage parser statistics')
+
+    args = parser.parse_args()
+
+    files = sorted(glob.glob(os.path.join(args.directory, args.pattern)))
+
+    if not files:
+        parser.error('no files matching {}'.format(
+            os.path.join(args.directory, args.pattern)))
+
+    cache = ParseCache(args.cache) if args.cache is not None else None
+
+    stats = ingest(args.database, files, args.user, args.workers, cache,
+                   args.refresh, profile=args.profile)
+
+    print(
+        '{files} files: {parsed} parsed, {failed} failed, {unknown} unknown, '
+        '{updated} merged'.format(**stats)
+    )
+    print(
+        'parse: {:.2f} s ({:.1f} files/s, {:.0f} fits/s), total: {:.2f} s'.format(
+            stats['parse_time'],
+            stats['parsed'] / max(stats['parse_time'], 1e-9),
+            stats['fits'] / max(stats['parse_time'], 1e-9),
+            stats['total_time'],
+        )
+    )
+
+
+if __name__ == '__main__':
+    main()
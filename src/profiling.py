@@ -0,0 +1,152 @@
+# pylint: disable=missing-docstring,invalid-name
+
+from contextlib import contextmanager, nullcontext
+from datetime import datetime
+import json
+import time
+import tracemalloc
+
+
+class ParseStats:
+    """
+    Collects per-stage statistics of a parser run: wall time, number of calls,
+    peak memory (optional) and stage-specific counters, such as the number of
+    fit iterations. Stages may be nested, and repeated stages accumulate.
+    A disabled object records nothing, at (almost) no cost.
+    """
+
+    def __init__(self, memory=False, log=None, enabled=True):
+        """
+        Initializes a ParseStats object.
+        :param bool memory: Record the peak memory of each stage, with
+            tracemalloc (slows down allocations while enabled).
+        :param str log: Path to a JSON lines file, to which the statistics of
+            every run are appended, or None.
+        :param bool enabled: Whether statistics are recorded.
+        """
+        self.memory = memory
+        self.log = log
+        self.enabled = enabled
+
+        self.stages = {}
+        self.runs = []
+
+        self._stack = []
+        self._tracing = False
+
+    @contextmanager
+    def _stage(self, name):
+        if self.memory and not tracemalloc.is_tracing():
+            tracemalloc.start()
+            self._tracing = True
+
+        # frame: [peak, current at entry]
+        frame = [0, 0]
+
+        if self.memory:
+            current, peak = tracemalloc.get_traced_memory()
+
+            if self._stack:
+                self._stack[-1][0] = max(self._stack[-1][0], peak)
+
+            tracemalloc.reset_peak()
+            frame = [current, current]
+
+        self._stack.append(frame)
+
+        start = time.perf_counter()
+
+        try:
+            yield
+        finally:
+            elapsed = time.perf_counter() - start
+
+            self._stack.pop()
+
+            stage = self.stages.setdefault(name, {'time': 0., 'calls': 0})
+            stage['time'] += elapsed
+            stage['calls'] += 1
+
+            if self.memory:
+                frame[0] = max(frame[0], tracemalloc.get_traced_memory()[1])
+
+                if self._stack:
+                    self._stack[-1][0] = max(self._stack[-1][0], frame[0])
+
+                stage['memory'] = max(stage.get('memory', 0),
+                    frame[0] - frame[1])
+
+    def stage(self, name):
+        """
+        Returns a context manager that records the time (and memory) spent
+        in a stage.
+        :param str name: The stage name.
+        """
+        if not self.enabled:
+            return nullcontext()
+
+        return self._stage(name)
+
+    def count(self, name, **counters):
+        """
+        Adds to the counters of a stage.
+        :param str name: The stage name.
+        :param counters: Counter names and values.
+        """
+        if not self.enabled:
+            return
+
+        stage = self.stages.setdefault(name, {'time': 0., 'calls': 0})
+
+        for k, v in counters.items():
+            stage[k] = stage.get(k, 0) + v
+
+    def record(self, raw):
+        """
+        Closes the statistics of a run on a data file, appends them to the
+        JSON log (if any) and resets the stages for the next run. Returns the
+        statistics of the run.
+        :param str raw: Path to the data file.
+        """
+        if not self.enabled:
+            return None
+
+        if self._tracing:
+            tracemalloc.stop()
+            self._tracing = False
+
+        run = {
+            'file': raw,
+            'date': datetime.now().isoformat(timespec='seconds'),
+            'stages': self.stages,
+        }
+
+        self.runs.append(run)
+        self.stages = {}
+
+        if self.log is not None:
+            with open(self.log, 'a') as fp:
+                fp.write(json.dumps(run) + '\n')
+
+        return run
+
+    def summary(self):
+        """
+        Returns a text table of the stages of the last run.
+        """
+        if not self.runs:
+            return ''
+
+        stages = self.runs[-1]['stages']
+
+        lines = ['{:<12} {:>10} {:>8} {:>12}'.format(
+            'stage', 'time [s]', 'calls', 'memory [kB]')]
+
+        for name, stage in stages.items():
+            memory = stage.get('memory')
+            lines.append('{:<12} {:>10.4f} {:>8} {:>12}'.format(
+                name, stage['time'], stage['calls'],
+                '{:.0f}'.format(memory / 1024) if memory is not None else '-'
+            ))
+
+        return '\n'.join(lines)
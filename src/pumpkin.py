@@ -9,18 +9,25 @@ from PIL import Image, ImageTk
 from matplotlib.backends.backend_tkagg import FigureCanvasTkAgg
 import matplotlib.pyplot as plt
 import numpy as np
-from numpy import array
 import tkinter as tk
 import tkinter.font
 from tkinter import filedialog, ttk
 
+from cache import ParseCache
 from display import draw_graph
+from formats import ParseStage
 from helper import SquashHelper
 from utils import slice_from_string
 
 
 ADC_DB_PATH = '/gpfs/mnt/gpfs02/sphenix/user/cmcginn/sPHENIXBoards/squash/src/ADC_boards.db'
 XMIT_DB_PATH = '/gpfs/mnt/gpfs02/sphenix/user/cmcginn/sPHENIXBoards/squash/src/XMIT_boards.db'
+PARSE_CACHE_DIR = os.path.join(os.path.expanduser('~'), '.cache', 'squash')
+
+# database journal mode, which opening a database converts it to: 'wal',
+# 'delete', or 'auto' for WAL except on network filesystems (such as GPFS,
+# shared between hosts); unset, the database file is left as it is
+DB_JOURNAL = os.environ.get('SQUASH_JOURNAL')
 
 
 class SIModes(Enum):
@@ -847,8 +854,7 @@ class SquashInterface:
             self.clear_figure()
 
             try:
-                for t in text.split(', '):
-                    self.update_database_entry(t)
+                self.update_database_entry(text)
             except FileNotFoundError:
                 self.set_notify_warning('file not found')
             except IndexError:
@@ -1007,19 +1013,9 @@ class SquashInterface:
                 self.set_notify_warning('data file(s) absent')
                 return
 
-            padding = g_min * 16
-
-            _y = np.zeros((padding, 40))
-            _p = np.zeros((padding, 2))
-
-            for f in files[g_min:g_max]:
-                _, _, _, y, pars, _ = self.squash.parse(
-                    os.path.join(os.path.dirname(self.squash.path), f),
-                    callback=self.set_progress
-                )
-
-                _y = np.vstack((_y, y))
-                _p = np.vstack((_p, pars))
+            _, _, _, _y, _p, _ = self.squash.parse_board(
+                entry, groups=range(g_min, g_max), callback=self.set_progress
+            )
 
             _y = _y[sel,:]
             _p = _p[sel,:]
@@ -1061,19 +1057,10 @@ class SquashInterface:
                 self.set_notify_warning('data file(s) absent')
                 return
 
-            padding = g_min * 16
-
-            _m = np.zeros((40, padding, 28))
-            _s = np.zeros((40, padding, 28))
-
-            for f in files[g_min:g_max]:
-                _, mean, sigma, _, _, _ = self.squash.parse(
-                    os.path.join(os.path.dirname(self.squash.path), f),
-                    callback=self.set_progress
-                )
-
-                _m = np.concatenate((_m, mean), axis=1)
-                _s = np.concatenate((_s, sigma), axis=1)
+            _, _m, _s, _, _, _ = self.squash.parse_board(
+                entry, groups=range(g_min, g_max), callback=self.set_progress,
+                stage=ParseStage.DECODE
+            )
 
             _m = _m[psel,csel,:]
             _s = _s[psel,csel,:]
@@ -1225,9 +1212,16 @@ class SquashInterface:
         if os.path.isfile(text) is False:
             raise FileNotFoundError
 
-        self.squash = SquashHelper(text)
+        self.squash = SquashHelper(text, cache=ParseCache(PARSE_CACHE_DIR),
+            journal=DB_JOURNAL)
         self.version = self.squash.version
 
+        if self.version is not None:
+            failed = self.squash.migrate()
+            if failed:
+                self.set_notify_warning('index not built: {}'.format(
+                    ', '.join(failed)))
+
         self.master.title('[{}] pumpkin.py [{}]'.format(
             self.version, os.path.basename(text))
         )
@@ -1252,13 +1246,11 @@ class SquashInterface:
         """
         serial, qrcode, location, rack, crate, slot, det, comment = data
 
-        query = 'WHERE serial = {}'.format(repr(serial))
-        if len(self.squash.select(query)) > 0:
+        if len(self.squash.select(where={'serial': serial})) > 0:
             self.set_notify_warning('{} already exists'.format(serial))
             return False
 
-        query = 'WHERE id = {}'.format(repr(qrcode))
-        if qrcode != '' and len(self.squash.select(query)) > 0:
+        if qrcode != '' and len(self.squash.select(where={'id': qrcode})) > 0:
             self.set_notify_warning('{} already exists'.format(qrcode))
             return False
 
@@ -1304,64 +1296,48 @@ class SquashInterface:
     @Decorators.show_progress
     def update_database_entry(self, text):
         """
-        XXX
+        Parses data files and updates the database entries of their boards,
+        all at once (or none if one fails), then draws the pulse maxima of
+        every file.
+        :param str text: Comma-separated paths to the data files.
         """
-        if os.path.isfile(text) is False:
+        files = text.split(', ')
+
+        if not all(os.path.isfile(t) for t in files):
             raise FileNotFoundError
 
-        entry, _, _, y, pars, _ = self.squash.parse(
-            text, callback=self.set_progress
-        )
+        # parse before the transaction, which holds the database write lock
+        results = [
+            self.squash.parse(t, callback=self.set_progress) for t in files
+        ]
 
-        serial = entry['serial']
-        group = entry['offset'] // 16
+        with self.squash.transaction():
+            for entry, *_ in results:
+                serial = entry['serial']
 
-        condition = 'WHERE serial = {}'.format(repr(serial))
+                data = self.squash.label(
+                    self.squash.select(where={'serial': serial})[0])
+                data = self.squash.merge(data, entry, self.user)
 
-        data = self.squash.label(self.squash.select(condition)[0])
+                self.squash.update(*zip(*data.items()), where={'serial': serial})
 
-        files = data['files'].split(', ')
-        files[group] = os.path.relpath(
-            entry['files'].split(', ')[group],
-            os.path.dirname(self.squash.path)
-        )
+        for entry, _, _, y, pars, _ in results:
+            self.draw_update(entry, y, pars)
 
-        history = entry['history'] + ' <{}>'.format(self.user)
+    def draw_update(self, entry, y, pars):
+        """
+        Draws the pulse maxima against the steps, of the channels of a parsed
+        data file.
+        :param dict entry: The parsed entry.
+        :param array y: The pulse maxima, (16, nstep).
+        :param array pars: The pedestals and gains, (16, 2).
+        """
+        serial = entry['serial']
+        group = entry['offset'] // 16
 
         i_min = group * 16
         i_max = i_min + 16
 
-        pedes = eval(data['pedes'].replace('\\n', ''))
-        gains = eval(data['gains'].replace('\\n', ''))
-        pedes[i_min:i_max] = eval(entry['pedes'])[i_min:i_max]
-        gains[i_min:i_max] = eval(entry['gains'])[i_min:i_max]
-
-        entry['files'] = ', '.join(files)
-        entry['pedes'] = np.array_repr(pedes)
-        entry['gains'] = np.array_repr(gains)
-
-        entry['location'] = data['location']
-        entry['history'] = ', '.join([data['history'], history])
-        entry['status'] = data['status']
-        entry['rack'] = data['rack']
-        entry['crate'] = data['crate']
-        entry['slot'] = data['slot']
-        entry['detector'] = data['detector']
-
-        if entry['comment']:
-            comments = [x for x in data['comment'].split('; ') if x]
-            comments.extend(entry['comment'].split('; '))
-            comments.append(
-                '{} parser errors ({}:{}) <{}>'.format(
-                    len(entry['comment'].split('; ')), i_min, i_max - 1, self.user
-                )
-            )
-            entry['comment'] = '; '.join(comments)
-        else:
-            entry['comment'] = data['comment']
-
-        self.squash.update(*zip(*entry.items()), condition)
-
         # draw pulse maximum vs steps
         pulse_max_vs_step_disp_opts = {
             'yrange': (0, 18000, 4000),
@@ -1433,15 +1409,16 @@ class SquashInterface:
         self.treeview_boardInfo.delete(*self.treeview_boardInfo.get_children())
 
         if not text:
-            pass
+            self.results = self.squash.select()
         elif re.match('^E[0-9]{6}$', text):
-            text = 'WHERE serial = {}'.format(repr(text))
+            self.results = self.squash.select(where={'serial': text})
         elif re.match('^[0-9]{1,3}$', text):
-            text = 'WHERE id = {}'.format(repr(text))
+            self.results = self.squash.select(where={'id': text})
         elif not text.upper().startswith('WHERE '):
-            text = 'WHERE {}'.format(text)
+            self.results = self.squash.select('WHERE {}'.format(text))
+        else:
+            self.results = self.squash.select(text)
 
-        self.results = self.squash.select(text)
         self.query = text
         self.index = None
 
@@ -1556,9 +1533,7 @@ class SquashInterface:
         entry['slot'] = slot
         entry['detector'] = det
 
-        condition = 'WHERE serial = {}'.format(repr(entry['serial']))
-
-        self.squash.update(*zip(*entry.items()), condition)
+        self.squash.update(*zip(*entry.items()), where={'serial': entry['serial']})
 
 
 if __name__ == '__main__':
@@ -1,6 +1,44 @@
 # pylint: disable=missing-docstring,invalid-name
 
+from contextlib import contextmanager
+from functools import lru_cache
+import os
+import queue
 import sqlite3
+import threading
+from urllib.request import pathname2url
+
+
+# filesystems whose locks and shared memory are not coherent between hosts,
+# which rules out the WAL journal
+NETWORK_FILESYSTEMS = (
+    'nfs', 'nfs4', 'cifs', 'smb3', 'smbfs', 'gpfs', 'lustre', 'afs', 'ceph',
+    'fuse.sshfs', 'fuse.glusterfs', '9p',
+)
+
+
+def filesystem(path):
+    """
+    Returns the type of the filesystem holding a path (as listed in
+    /proc/mounts), or None if it is not known.
+    :param str path: The system path.
+    """
+    path = os.path.realpath(path)
+
+    try:
+        with open('/proc/mounts') as fp:
+            mounts = [x.split()[1:3] for x in fp]
+    except OSError:
+        return None
+
+    # the longest mount point containing the path
+    matches = [
+        (len(point), kind)
+        for point, kind in mounts
+        if path == point or path.startswith(point.rstrip('/') + '/')
+    ]
+
+    return max(matches)[1] if matches else None
 
 
 class SquashError(Exception):
@@ -40,12 +78,36 @@ class Squash:
     connection = None
     path = None
 
-    def __init__(self, path):
+    # journal mode of the database (see set_journal), and read-only
+    # connections used by selections in WAL mode
+    journal = None
+    pool = None
+
+    # serializes the use of the (writer) connection between threads, and the
+    # thread within a transaction
+    lock = None
+    owner = None
+
+    # seconds a connection waits for the lock of another connection
+    timeout = 30.
+
+    # depth of nested transactions (see transaction)
+    depth = 0
+
+    # cached tables and columns (see load_schema)
+    schema = None
+
+    # number of compiled statements kept by each connection
+    cached_statements = 256
+
+    def __init__(self, path, journal=None, readers=2):
         """
         Initializes a Squash object that interfaces with the board database.
         :param str path: The system path to the SQLite database.
+        :param str journal: The journal mode (see set_journal).
+        :param int readers: Number of read-only connections in WAL mode.
         """
-        self.open(path) # Takes in a database path and opens it
+        self.open(path, journal, readers) # Takes in a database path and opens it
 
     def __str__(self):
         """
@@ -76,48 +138,323 @@ class Squash:
             :param function f: The function to be decorated.
             """
             def wrapper(self, *args, **kwargs):
-                cursor = self.connection.cursor()
-
-                query = 'SELECT name FROM sqlite_master'
-                cursor.execute(query)
-
-                tables = cursor.fetchall()
-                if not tables:
-                    raise SquashEmptyError
+                # trust a non-empty schema cache: a table dropped since would
+                # make the query itself fail
+                if self.schema is None or not self.schema['tables']:
+                    if not self.load_schema()['tables']:
+                        raise SquashEmptyError
 
                 return f(self, *args, **kwargs)
 
             return wrapper
 
-    def open(self, path):
+    def open(self, path, journal=None, readers=2):
         """
         Opens the connection to the SQLite database. Raises an error if the
-        connection fails.
+        connection fails. In WAL mode, selections use a pool of read-only
+        connections, which never wait on the writer connection.
         :param str path: The system path to the SQLite database.
+        :param str journal: The journal mode (see set_journal).
+        :param int readers: Number of read-only connections in WAL mode.
         """
         try:
-            self.connection = sqlite3.connect(path)
+            self.connection = self.connect(path)
             self.path = path
+            self.depth = 0
+            self.schema = None
+            self.lock = threading.RLock()
+            self.owner = None
+            self.pool = None
+
+            self.journal = self.set_journal(journal)
+
+            if self.journal == 'wal' and readers > 0:
+                self.pool = queue.Queue()
+                for _ in range(readers):
+                    self.pool.put(self.connect(path, readonly=True))
+
+            self.load_schema()
         except sqlite3.Error as e:
             print(e)
 
+    def connect(self, path, readonly=False):
+        """
+        Returns a connection to the SQLite database.
+        :param str path: The system path to the SQLite database.
+        :param bool readonly: Open the database in read-only mode.
+        """
+        if readonly:
+            path = 'file:{}?mode=ro'.format(pathname2url(os.path.abspath(path)))
+
+        # transactions are managed explicitly (see transaction), outside of
+        # which every statement commits on its own
+        return sqlite3.connect(path, timeout=self.timeout, isolation_level=None,
+            cached_statements=self.cached_statements, check_same_thread=False,
+            uri=readonly)
+
+    def set_journal(self, journal=None):
+        """
+        Sets the journal mode of the database, and returns the mode in use.
+        The WAL journal lets readers and the writer proceed concurrently, but
+        needs shared memory between connections, which network filesystems do
+        not provide between hosts: there, the rollback journal is kept, and
+        busy connections wait for the lock (see timeout). If the mode cannot
+        be changed (e.g. while other connections are open), the current mode
+        is kept. The journal mode is stored in the database file, and applies
+        to every later connection.
+        :param str journal: 'wal', 'delete' (rollback journal), 'auto' for
+            WAL unless the database is on a network filesystem, or None to
+            keep the current mode (and leave the file untouched).
+        """
+        cursor = self.connection.cursor()
+
+        current = cursor.execute('PRAGMA journal_mode').fetchone()[0]
+
+        if journal is None or current == 'memory':
+            return current
+
+        if journal == 'auto':
+            network = filesystem(self.path) in NETWORK_FILESYSTEMS
+            journal = 'delete' if network else 'wal'
+
+        if journal == current:
+            return current
+
+        try:
+            mode = cursor.execute(
+                'PRAGMA journal_mode={}'.format(journal)).fetchone()[0]
+        except sqlite3.OperationalError:
+            return current
+
+        if mode != 'wal':
+            return mode
+
+        try:
+            cursor.execute('SELECT count(*) FROM sqlite_master').fetchone()
+        except sqlite3.OperationalError:
+            # no shared memory: the WAL journal can only be left with an
+            # exclusive lock
+            cursor.execute('PRAGMA locking_mode=EXCLUSIVE')
+            mode = cursor.execute('PRAGMA journal_mode=DELETE').fetchone()[0]
+            cursor.execute('PRAGMA locking_mode=NORMAL')
+            cursor.execute('SELECT count(*) FROM sqlite_master').fetchone()
+
+        return mode
+
+    @contextmanager
+    def reader(self):
+        """
+        Returns a context manager that provides a connection for selections:
+        a read-only connection from the pool in WAL mode, or else the writer
+        connection. Within a transaction, its own thread reads from the writer
+        connection, to see its uncommitted changes.
+        """
+        if self.pool is None or (
+            self.depth > 0 and self.owner == threading.get_ident()
+        ):
+            with self.lock:
+                yield self.connection
+            return
+
+        connection = self.pool.get()
+
+        try:
+            yield connection
+        finally:
+            self.pool.put(connection)
+
     @Decorators.check_connection
     def close(self):
         """
         Closes the connection to the SQLite database and resets the connection
         and path variables.
         """
+        if self.pool is not None:
+            while not self.pool.empty():
+                self.pool.get().close()
+
         self.connection.close()
 
         self.connection = None
         self.path = None
+        self.schema = None
+        self.pool = None
+
+    @Decorators.check_connection
+    def load_schema(self):
+        """
+        Loads the names of the tables in the database, of their columns and of
+        their indexes, into the schema cache. The cache is only reloaded when
+        the schema version of the database has changed since it was loaded.
+        Returns the schema cache.
+        """
+        with self.lock:
+            return self._load_schema()
+
+    def _load_schema(self):
+        cursor = self.connection.cursor()
+
+        version = cursor.execute('PRAGMA schema_version').fetchone()[0]
+
+        if self.schema is not None and self.schema['version'] == version:
+            return self.schema
+
+        query = 'SELECT type, name, tbl_name FROM sqlite_master'
+        objects = cursor.execute(query).fetchall()
+
+        tables = {
+            name: tuple(
+                x[1] for x in
+                cursor.execute('pragma table_info({})'.format(name)).fetchall()
+            )
+            for kind, name, _ in objects
+            if kind == 'table' and not name.startswith('sqlite_')
+        }
+
+        indexes = {
+            name: table
+            for kind, name, table in objects
+            if kind == 'index' and not name.startswith('sqlite_')
+        }
+
+        self.schema = { 'version': version, 'tables': tables, 'indexes': indexes }
+
+        return self.schema
+
+    def columns(self, table='data'):
+        """
+        Returns the names of the columns of a table, from the schema cache, or
+        an empty tuple if there is no such table.
+        :param str table: The name of the data table.
+        """
+        if self.schema is None:
+            self.load_schema()
+
+        return self.schema['tables'].get(table, ())
+
+    def indexes(self, table='data'):
+        """
+        Returns the names of the indexes of a table, from the schema cache.
+        :param str table: The name of the data table.
+        """
+        if self.schema is None:
+            self.load_schema()
+
+        return [k for k, v in self.schema['indexes'].items() if v == table]
+
+    @staticmethod
+    @lru_cache(maxsize=256)
+    def statement(kind, table, columns=(), where=()):
+        """
+        Builds the text of a parameterized SQL statement. The text only
+        depends on the table and column names (and the number of values of IN
+        clauses), so repeated calls return the same text, and the connection
+        reuses the compiled statement.
+        :param str kind: 'INSERT', 'SELECT' or 'UPDATE'.
+        :param str table: The name of the data table.
+        :param tuple columns: Columns to insert, select or update.
+        :param tuple where: Conditions, as (column, number of values) pairs,
+            with None for a single value (=) and a number for an IN clause.
+        """
+        conditions = ' AND '.join(
+            '{} = ?'.format(k) if n is None
+            else '{} IN ({})'.format(k, ', '.join(['?'] * n))
+            for k, n in where
+        )
+        fwhere = ' WHERE {}'.format(conditions) if where else ''
+
+        if kind == 'INSERT':
+            return 'INSERT INTO {} ({}) VALUES ({})'.format(
+                table, ', '.join(columns), ', '.join(['?'] * len(columns)))
+        if kind == 'SELECT':
+            return 'SELECT {} FROM {}{}'.format(
+                ', '.join(columns), table, fwhere)
+        if kind == 'UPDATE':
+            return 'UPDATE {} SET {}{}'.format(
+                table, ', '.join('{} = ?'.format(k) for k in columns), fwhere)
+
+        raise ValueError(kind)
+
+    @staticmethod
+    def bind(where):
+        """
+        Splits conditions into the where argument of statement, and the
+        values to bind. Values that are lists, tuples or sets match any of
+        their elements.
+        :param dict where: Column names and values.
+        """
+        keys = []
+        values = []
+
+        for k, v in (where or {}).items():
+            if isinstance(v, (list, tuple, set, frozenset)):
+                v = list(v)
+                keys.append((k, len(v)))
+                values.extend(v)
+            else:
+                keys.append((k, None))
+                values.append(v)
+
+        return tuple(keys), values
 
     @Decorators.check_connection
     def write(self):
         """
-        Commits data to the database.
+        Commits data to the database, unless within a transaction (which
+        commits when it exits).
+        """
+        if self.depth == 0 and self.connection.in_transaction:
+            self.connection.commit()
+
+    @contextmanager
+    def transaction(self):
+        """
+        Returns a context manager that groups the statements executed within
+        it into a single transaction, committed on exit and rolled back if an
+        exception is raised. Transactions may be nested: inner transactions
+        are savepoints, which only roll back their own statements. A
+        transaction holds the write lock of the database from its start, and
+        excludes the transactions of other threads.
         """
-        self.connection.commit()
+        if self.connection is None or self.path is None:
+            raise SquashConnectionError
+
+        with self.lock:
+            cursor = self.connection.cursor()
+
+            savepoint = 'squash_{}'.format(self.depth)
+
+            if self.depth == 0:
+                # waits (see timeout) for other writers, rather than failing
+                # to upgrade a read lock later
+                cursor.execute('BEGIN IMMEDIATE')
+                self.owner = threading.get_ident()
+            else:
+                cursor.execute('SAVEPOINT {}'.format(savepoint))
+
+            self.depth += 1
+
+            try:
+                yield self
+            except BaseException:
+                self.depth -= 1
+
+                if self.depth == 0:
+                    self.owner = None
+                    self.connection.rollback()
+                else:
+                    cursor.execute('ROLLBACK TO {}'.format(savepoint))
+                    cursor.execute('RELEASE {}'.format(savepoint))
+
+                raise
+
+            self.depth -= 1
+
+            if self.depth == 0:
+                self.owner = None
+                self.connection.commit()
+            else:
+                cursor.execute('RELEASE {}'.format(savepoint))
     
     
     # SQL Query Functions
@@ -129,13 +466,16 @@ class Squash:
         Queries the database and executes the provided SQLite command.
         :param str command: SQL command to execute.
         """
-        cursor = self.connection.cursor()
+        with self.lock:
+            cursor = self.connection.cursor()
 
-        cursor.execute(command)
+            cursor.execute(command)
+            result = cursor.fetchall()
 
-        self.write()
+        # the command may have changed the schema
+        self.load_schema()
 
-        return cursor.fetchall()
+        return result
 
     @Decorators.check_connection
     def insert_table(self, columns, table='data'):
@@ -148,9 +488,46 @@ class Squash:
 
         fcolumns = ', '.join('{} {}'.format(k, v) for k, v in columns.items())
         query = 'CREATE TABLE {} ({})'.format(table, fcolumns)
-        cursor.execute(query)
 
-        self.write()
+        with self.transaction():
+            cursor.execute(query)
+
+        self.load_schema()
+
+    @Decorators.check_connection
+    def insert_index(self, name, columns, unique=False, table='data'):
+        """
+        Creates an index on columns of a data table, unless it exists. Raises
+        sqlite3.IntegrityError if a unique index is requested on columns
+        holding duplicate values.
+        :param str name: The name of the index.
+        :param list/tuple columns: Indexed columns.
+        :param bool unique: Whether the indexed values must be unique.
+        :param str table: The name of the data table.
+        """
+        cursor = self.connection.cursor()
+
+        query = 'CREATE {}INDEX IF NOT EXISTS {} ON {} ({})'.format(
+            'UNIQUE ' if unique else '', name, table, ', '.join(columns))
+
+        with self.transaction():
+            cursor.execute(query)
+
+        self.load_schema()
+
+    @Decorators.check_connection
+    def explain(self, query, parameters=()):
+        """
+        Returns the query plan of a statement, one line per step, as reported
+        by EXPLAIN QUERY PLAN, e.g. 'SEARCH data USING INDEX data_serial
+        (serial=?)' or 'SCAN data' for a full table scan.
+        :param str query: The SQL statement.
+        :param list/tuple parameters: Values bound to the statement.
+        """
+        query = 'EXPLAIN QUERY PLAN {}'.format(query)
+
+        with self.reader() as connection:
+            return [x[-1] for x in connection.execute(query, parameters)]
 
     @Decorators.check_connection
     @Decorators.check_empty
@@ -161,14 +538,7 @@ class Squash:
         :param list/tuple data: List of data values to insert
         :param str table: The name of the database that data is added to.
         """
-        cursor = self.connection.cursor()
-
-        fcolumns = ', '.join(columns)
-        fdata = ', '.join(repr(d) for d in data)
-        query = 'INSERT INTO {} ({}) VALUES ({})'.format(table, fcolumns, fdata)
-        cursor.execute(query)
-
-        self.write()
+        self.insert_values(dict(zip(columns, data)), table)
 
     @Decorators.check_connection
     @Decorators.check_empty
@@ -177,12 +547,10 @@ class Squash:
         Selects all data from the provided data table.
         :param str table: The name of the data table.
         """
-        cursor = self.connection.cursor()
-
         query = 'SELECT * FROM sqlite_master WHERE name LIKE {}'.format(table)
-        cursor.execute(query)
 
-        return cursor.fetchall()
+        with self.reader() as connection:
+            return connection.execute(query).fetchall()
 
     @Decorators.check_connection
     @Decorators.check_empty
@@ -193,12 +561,10 @@ class Squash:
         :param str condition: Conditional statements for the query.
         :param str table: The name of the table to access data from.
         """
-        cursor = self.connection.cursor()
-
         query = 'SELECT {} FROM {} {}'.format(column, table, condition)
-        cursor.execute(query)
 
-        return cursor.fetchall()
+        with self.reader() as connection:
+            return connection.execute(query).fetchall()
 
     @Decorators.check_connection
     @Decorators.check_empty
@@ -214,6 +580,81 @@ class Squash:
 
         fupdate = ','.join(['{} = ?'.format(k) for k in columns])
         query = 'UPDATE {} SET {} {}'.format(table, fupdate, condition)
-        cursor.execute(query, tuple(data))
 
-        self.write()
+        with self.transaction():
+            cursor.execute(query, tuple(data))
+
+    @Decorators.check_connection
+    @Decorators.check_empty
+    def update_entries(self, columns, data, key, table='data'):
+        """
+        Updates many database entries with a single statement, executed for
+        each row, within one transaction.
+        :param list/tuple columns: List of data categories to update.
+        :param list data: List of rows, each holding the values of the columns
+            followed by the value of the key column identifying the entry.
+        :param str key: The column identifying the entries.
+        :param str table: The name of the data table that is being updated.
+        """
+        cursor = self.connection.cursor()
+
+        query = self.statement('UPDATE', table, tuple(columns), ((key, None),))
+
+        with self.transaction():
+            cursor.executemany(query, [tuple(d) for d in data])
+
+    @Decorators.check_connection
+    @Decorators.check_empty
+    def insert_values(self, values, table='data'):
+        """
+        Inserts rows of data into the database, with bound parameters.
+        :param dict/list values: Column names and values of a row, or a list
+            of rows with the same columns.
+        :param str table: The name of the data table.
+        """
+        rows = [values] if isinstance(values, dict) else list(values)
+        if not rows:
+            return
+
+        columns = tuple(rows[0].keys())
+        query = self.statement('INSERT', table, columns)
+
+        cursor = self.connection.cursor()
+
+        with self.transaction():
+            cursor.executemany(query, [tuple(r[k] for k in columns) for r in rows])
+
+    @Decorators.check_connection
+    @Decorators.check_empty
+    def select_values(self, where=None, columns=('*',), table='data'):
+        """
+        Selects the rows of the database whose columns match the provided
+        values, with bound parameters.
+        :param dict where: Column names and values to match (see bind), or
+            None to select every row.
+        :param tuple columns: Columns to select.
+        :param str table: The name of the data table.
+        """
+        keys, values = self.bind(where)
+        query = self.statement('SELECT', table, tuple(columns), keys)
+
+        with self.reader() as connection:
+            return connection.execute(query, values).fetchall()
+
+    @Decorators.check_connection
+    @Decorators.check_empty
+    def update_values(self, values, where, table='data'):
+        """
+        Updates the rows of the database whose columns match the provided
+        values, with bound parameters.
+        :param dict values: Column names and new values.
+        :param dict where: Column names and values to match (see bind).
+        :param str table: The name of the data table.
+        """
+        keys, bound = self.bind(where)
+        query = self.statement('UPDATE', table, tuple(values.keys()), keys)
+
+        cursor = self.connection.cursor()
+
+        with self.transaction():
+            cursor.execute(query, list(values.values()) + bound)
@@ -0,0 +1,114 @@
+# pylint: disable=missing-docstring,invalid-name
+
+import numpy as np
+
+from fitting import find_pulse_maximum
+from utils import powerlaw_doubleexp
+
+
+HEX_CHARS = np.frombuffer(b'0123456789abcdef', dtype=np.uint8)
+
+# powerlaw_doubleexp shape parameters (b, c, d, f, g) of a typical pulse
+PULSE_SHAPE = (3.5, 0.66, 0.96, 0.56, 2.77)
+
+
+def format_dwords(dwords):
+    """
+    Formats dwords as lines of 8 space-separated, 8-digit hex numbers, in one
+    pass. Returns the text as a uint8 array.
+    :param array dwords: The dwords, (..., 8).
+    """
+    shifts = np.arange(28, -4, -4, dtype=np.uint32)
+    digits = HEX_CHARS[(dwords[...,None] >> shifts) & 0xF]
+
+    line = np.full(dwords.shape[:-1] + (8, 9), ord(' '), dtype=np.uint8)
+    line[...,:8] = digits
+
+    line = line.reshape(dwords.shape[:-1] + (72,))
+
+    return np.concatenate(
+        (line, np.full(line.shape[:-1] + (1,), ord('\n'), dtype=np.uint8)),
+        axis=-1,
+    )
+
+
+def generate_dat(path, serial='E000001', group=0, nstep=40, ntrial=100,
+                 nsample=28, dacperstep=100, pedestal=(1500., 30.),
+                 gain=(370., 5.), noise=8., shape=PULSE_SHAPE, jitter=0.,
+                 seed=None):
+    """
+    Writes a synthetic ADC charge injection .dat file, as read by
+    DataFormat_v1.parser, and returns the true pedestal and gain of its 16
+    channels. Each channel records a powerlaw_doubleexp pulse per event,
+    whose maximum grows linearly with the step: pedestal + gain * step, with
+    gaussian noise on every sample. Samples are rounded and clipped to the
+    14-bit ADC range. The other channel groups only record their pedestals.
+    :param str path: Path to the .dat file.
+    :param str serial: The board serial number (BOARDID).
+    :param int group: The channel group (0 to 3) holding the data.
+    :param int nstep: Number of injection steps.
+    :param int ntrial: Number of events per step.
+    :param int nsample: Number of samples per pulse.
+    :param int dacperstep: DAC increment per step (DACPERSTEP).
+    :param tuple pedestal: Mean and spread of the channel pedestals.
+    :param tuple gain: Mean and spread of the channel gains (pulse maximum
+        per step).
+    :param float noise: Standard deviation of the sample noise.
+    :param tuple shape: Pulse shape parameters (b, c, d, f, g), see
+        powerlaw_doubleexp.
+    :param float jitter: Relative spread of the pulse shape parameters
+        between channels.
+    :param int seed: Seed of the random number generator.
+    """
+    rng = np.random.default_rng(seed)
+
+    truth = {
+        'pedestal': rng.normal(*pedestal, 16),
+        'gain': rng.normal(*gain, 16),
+    }
+
+    b, c, d, f, g = (
+        np.asarray(shape)[:,None] * (1. + jitter * rng.standard_normal((5, 16)))
+    )
+    f = np.clip(f, 0., 1.)
+
+    # pulse maximum of a unit amplitude, as found by the parser
+    ones = np.ones(16)
+    unit = find_pulse_maximum(
+        np.column_stack((ones, b, c, d, 0. * ones, f, g)), nsample)
+
+    x = np.arange(nsample)
+
+    with open(path, 'wb') as fp:
+        fp.write('BOARDID: {}\n'.format(serial).encode())
+        fp.write('CHANNELMIN: {}\n'.format(group * 16).encode())
+        fp.write('NUMBEROFSTEPS: {}\n'.format(nstep).encode())
+        fp.write('EVENTSPERSTEP: {}\n'.format(ntrial).encode())
+        fp.write('DACPERSTEP: {}\n'.format(dacperstep).encode())
+        fp.write('NSAMPLES: {}\n'.format(nsample).encode())
+        fp.write(b'-' * 32 + b'\n')
+
+        for i in range(nstep):
+            a = truth['gain'] * i / unit
+
+            with np.errstate(invalid='ignore'):
+                pulse = powerlaw_doubleexp(x, *(
+                    v[:,None] for v in (a, b, c, d, 0. * ones, f, g)))
+
+            adc = np.full((ntrial, 4, 16, nsample), truth['pedestal'][:,None])
+            adc[:,group] += pulse
+            adc += rng.normal(0., noise, adc.shape)
+
+            adc = np.clip(np.rint(adc), 0, 16383).astype(np.uint32)
+
+            # channel 2k is the low and 2k + 1 the high word of dword k
+            dwords = adc[:,:,0::2] | (adc[:,:,1::2] << 16)
+            text = format_dwords(dwords.reshape(ntrial, 4 * nsample, 8))
+
+            for j in range(ntrial):
+                fp.write('EVENT: {} STEP: {}\n\n'.format(
+                    i * ntrial + j, i).encode())
+                fp.write(text[j].tobytes())
+                fp.write(b'\n\n')
+
+    return truth
@@ -1,11 +1,26 @@
 # pylint: disable=missing-docstring,invalid-name
 
+from enum import IntEnum
+import json
+import struct
+
 import numpy as np
 
 from itertools import zip_longest
 from scipy.optimize import curve_fit
 
 
+class ParseError(IntEnum):
+    """
+    Class for handling parser error types.
+    """
+    NONE = 0
+    SIGMA = 1
+    PSAT = 2
+    PZERO = 3
+    FIT = 4
+
+
 def read_and_discard_lines(f, count):
     """
     Reads and discards a set number of lines of a file.
@@ -20,15 +35,74 @@ def read_config_line(f):
     """
     Reads a colon-separated line of the provided input file and splits it into a list
     of values.
-    :param file f: The file to read from.
+    :param file f: The file (or memory map) to read from.
+    """
+    line = f.readline()
+
+    if isinstance(line, bytes):
+        line = line.decode('ascii')
+
+    return [x.strip() for x in line.split(':')]
+
+
+def index_lines(buf, chunk=1 << 22):
+    """
+    Builds an index of line offsets in a buffer, such that line n spans
+    offsets[n] to offsets[n + 1].
+    :param buffer buf: The buffer (e.g. a memory-mapped file) to index.
+    :param int chunk: Number of bytes scanned at once.
+    """
+    chars = np.frombuffer(buf, dtype=np.uint8)
+
+    # scan in chunks, to avoid a temporary mask as large as the buffer
+    offsets = np.concatenate([np.zeros(0, dtype=np.intp)] + [
+        np.flatnonzero(chars[k:k + chunk] == ord('\n')) + (k + 1)
+        for k in range(0, chars.size, chunk)
+    ])
+
+    # unterminated last line
+    if not offsets.size or offsets[-1] != chars.size:
+        offsets = np.append(offsets, chars.size)
+
+    return np.insert(offsets, 0, 0)
+
+
+HEX_DIGITS = np.full(256, 0xFF, dtype=np.uint8)
+HEX_DIGITS[0] = 0xFE
+HEX_DIGITS[np.frombuffer(b'0123456789', dtype=np.uint8)] = np.arange(10)
+HEX_DIGITS[np.frombuffer(b'abcdef', dtype=np.uint8)] = np.arange(10, 16)
+HEX_DIGITS[np.frombuffer(b'ABCDEF', dtype=np.uint8)] = np.arange(10, 16)
+
+
+def decode_dwords(block):
+    """
+    Decodes a block of whitespace-separated hex dwords in one pass.
+    :param str/bytes block: Text containing the hex dwords.
     """
-    return [x.strip() for x in f.readline().split(':')]
+    if isinstance(block, str):
+        block = block.encode('ascii')
+
+    words = np.array(block.split())
+    if words.size == 0:
+        return np.zeros(0, dtype=np.uint32)
+
+    digits = HEX_DIGITS[words.view(np.uint8).reshape(words.size, -1)]
+    if np.any(digits == 0xFF) or digits.shape[1] > 8:
+        raise ValueError('invalid hex dword in block')
+
+    dwords = np.zeros(words.size, dtype=np.uint32)
+
+    for column in digits.T:
+        valid = column != 0xFE
+        dwords[valid] = (dwords[valid] << 4) | column[valid]
+
+    return dwords
 
 
 def split_dword(dword):
     """
-    XXX
-    :param XXX dword:
+    Splits a dword (or an array of dwords) into its low and high words.
+    :param str/int/array dword: The dword(s) to split.
     """
     if isinstance(dword, str):
         dword = int(dword, 16)
@@ -36,6 +110,53 @@ def split_dword(dword):
     return dword & 0xFFFF, dword >> 16
 
 
+CONTAINER_MAGIC = b'SQSHRAW1'
+
+
+def write_container(path, header, shape, dtype='<u2'):
+    """
+    Creates a binary data container: a JSON header followed by a raw array,
+    aligned so that it can be memory-mapped. Returns the (writable) memory-mapped
+    array.
+    :param str path: The container file path.
+    :param dict header: Header information (must be JSON serializable).
+    :param tuple shape: Shape of the array.
+    :param str dtype: Data type of the array.
+    """
+    header = dict(header, shape=list(shape), dtype=np.dtype(dtype).str)
+    text = json.dumps(header).encode()
+
+    offset = -(-(len(CONTAINER_MAGIC) + 8 + len(text)) // 64) * 64
+
+    with open(path, 'wb') as fp:
+        fp.write(CONTAINER_MAGIC)
+        fp.write(struct.pack('<Q', len(text)))
+        fp.write(text)
+        fp.write(bytes(offset - fp.tell()))
+
+    return np.memmap(path, dtype=header['dtype'], mode='r+', offset=offset,
+        shape=tuple(shape))
+
+
+def read_container(path):
+    """
+    Opens a binary data container, and returns its header and the
+    (read-only) memory-mapped array.
+    :param str path: The container file path.
+    """
+    with open(path, 'rb') as fp:
+        if fp.read(len(CONTAINER_MAGIC)) != CONTAINER_MAGIC:
+            raise ValueError('not a data container: {}'.format(path))
+
+        length, = struct.unpack('<Q', fp.read(8))
+        header = json.loads(fp.read(length))
+
+    offset = -(-(len(CONTAINER_MAGIC) + 8 + length) // 64) * 64
+
+    return header, np.memmap(path, dtype=header['dtype'], mode='r',
+        offset=offset, shape=tuple(header['shape']))
+
+
 def slice_from_string(text):
     """
     Slices a colon-separated string into individual elements.
@@ -100,6 +221,42 @@ def powerlaw_doubleexp(x, a, b, c, d, e, f, g):
     return np.where(x < b, pedestal, signal)
 
 
+def powerlaw_doubleexp_jac(x, a, b, c, d, e, f, g):
+    """
+    Jacobian of the power law fit function, with the derivatives with respect
+    to (a, b, c, d, e, f, g) stacked along the last axis.
+    """
+    u = x - b
+    signal = u > 0
+    u = np.where(signal, u, 1.)
+
+    uc = np.power(u, c)
+    ld = 1. - np.log(d) - u / d
+    lg = 1. - np.log(g) - u / g
+
+    # d^-c e^c exp(-cu/d) and g^-c e^c exp(-cu/g)
+    e0 = np.exp(c * ld)
+    e1 = np.exp(c * lg)
+
+    t0 = (1. - f) * e0
+    t1 = f * e1
+    s = t0 + t1
+
+    jac = [
+        uc * s,
+        -a * uc * c * (s / u - t0 / d - t1 / g),
+        a * uc * (np.log(u) * s + t0 * ld + t1 * lg),
+        a * uc * t0 * c * (u - d) / (d * d),
+        None,
+        a * uc * (e1 - e0),
+        a * uc * t1 * c * (u - g) / (g * g),
+    ]
+
+    jac = [1. if j is None else np.where(signal, j, 0.) for j in jac]
+
+    return np.stack(np.broadcast_arrays(*jac), axis=-1)
+
+
 def powerlaw_singleexp(x, a, b, c, d, e):
     """
     Power law fit function.
@@ -108,3 +265,28 @@ def powerlaw_singleexp(x, a, b, c, d, e):
     signal = e + a * np.power(x - b, c) * np.exp((b - x) * d)
 
     return np.where(x < b, pedestal, signal)
+
+
+def powerlaw_singleexp_jac(x, a, b, c, d, e):
+    """
+    Jacobian of the power law fit function, with the derivatives with respect
+    to (a, b, c, d, e) stacked along the last axis.
+    """
+    u = x - b
+    signal = u > 0
+    u = np.where(signal, u, 1.)
+
+    uc = np.power(u, c)
+    ex = np.exp(-d * u)
+
+    jac = [
+        uc * ex,
+        -a * uc * ex * (c / u - d),
+        a * uc * ex * np.log(u),
+        -a * uc * ex * u,
+        None,
+    ]
+
+    jac = [1. if j is None else np.where(signal, j, 0.) for j in jac]
+
+    return np.stack(np.broadcast_arrays(*jac), axis=-1)
@@ -0,0 +1,74 @@
+import numpy as np
+import pytest
+
+from synthetic import generate_dat
+
+import formats
+
+
+@pytest.fixture(scope='module')
+def results(tmp_path_factory):
+    """
+    Parser results of a small synthetic file, for the default (float64,
+    streaming) path and its alternatives.
+    """
+    directory = tmp_path_factory.mktemp('data')
+
+    raw = str(directory / 'synthetic_Channel0.dat')
+    container = str(directory / 'synthetic.bin')
+
+    generate_dat(raw, nstep=10, ntrial=20, seed=1)
+
+    parser = formats.DataFormat_v1()
+    parser.convert(raw, container)
+
+    return {
+        'default': parser.parser(raw),
+        'float32': parser.parser(raw, dtype='float32'),
+        'events': parser.parser(raw, stream=False),
+        'container': parser.parser(container),
+    }
+
+
+def _pedes_gains(entry):
+    return [
+        eval(entry[k].replace('\\n', ''), {'array': np.array})
+        for k in ('pedes', 'gains')
+    ]
+
+
+@pytest.mark.parametrize('name', ['float32', 'events'])
+def test_calibration_matches(results, name):
+    entry, _, _, y, pars, errs = results[name]
+    _entry, _, _, _y, _pars, _errs = results['default']
+
+    np.testing.assert_allclose(pars, _pars, rtol=1e-6)
+    np.testing.assert_allclose(errs, _errs, rtol=1e-4)
+
+    for a, b in zip(_pedes_gains(entry), _pedes_gains(_entry)):
+        np.testing.assert_allclose(a, b, rtol=1e-4)
+
+    # the first two steps (no injected charge) are left out of the fits
+    np.testing.assert_allclose(y[:,2:], _y[:,2:], rtol=1e-4)
+
+
+def test_float32_statistics(results):
+    _, mean, sigma, _, _, _ = results['float32']
+    _, _mean, _sigma, _, _, _ = results['default']
+
+    assert mean.dtype == np.float32
+    assert sigma.dtype == np.float32
+
+    np.testing.assert_allclose(mean, _mean, rtol=1e-6)
+    np.testing.assert_allclose(sigma, _sigma, rtol=1e-5)
+
+
+def test_container_identical(results):
+    entry, *arrays = results['container']
+    _entry, *_arrays = results['default']
+
+    for a, b in zip(arrays, _arrays):
+        np.testing.assert_array_equal(a, b)
+
+    assert entry['pedes'] == _entry['pedes']
+    assert entry['gains'] == _entry['gains']
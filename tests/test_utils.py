@@ -0,0 +1,75 @@
+import numpy as np
+import pytest
+
+from utils import (
+    powerlaw_doubleexp,
+    powerlaw_doubleexp_jac,
+    powerlaw_singleexp,
+    powerlaw_singleexp_jac,
+)
+
+
+# samples on both sides of the pulse start b (x < b is the pedestal region),
+# away from the kink at x = b
+X = np.arange(28) + 0.37
+
+
+def numerical_jac(f, x, p, h=1e-6):
+    """
+    Central differences of f with respect to each parameter, stacked along
+    the last axis.
+    """
+    columns = []
+
+    for k in range(len(p)):
+        step = h * max(abs(p[k]), 1.)
+        hi, lo = list(p), list(p)
+        hi[k] += step
+        lo[k] -= step
+        # the model is evaluated (then discarded) at x < b too
+        with np.errstate(invalid='ignore'):
+            columns.append((f(x, *hi) - f(x, *lo)) / (2. * step))
+
+    return np.stack(columns, axis=-1)
+
+
+@pytest.mark.parametrize('p', [
+    (1000., 3.5, 0.66, 0.96, 1500., 0.56, 2.77),
+    (250., 5.2, 1.4, 2.1, 1200., 0.1, 6.5),
+    (4000., 1.1, 3.0, 0.5, 0., 0.9, 1.3),
+    (-20., 8.7, 0.3, 4.0, 1800., 0.5, 0.8),
+])
+def test_powerlaw_doubleexp_jac(p):
+    jac = powerlaw_doubleexp_jac(X, *p)
+    expected = numerical_jac(powerlaw_doubleexp, X, p)
+
+    assert jac.shape == (X.size, 7)
+    assert np.any(X < p[1])
+
+    scale = np.max(np.abs(expected), axis=0) + 1.
+    np.testing.assert_allclose(jac / scale, expected / scale, atol=1e-6)
+
+
+@pytest.mark.parametrize('p', [
+    (1000., 3.5, 2.0, 0.8, 1500.),
+    (250., 6.1, 0.7, 0.3, 1200.),
+    (-40., 1.9, 3.5, 1.6, 0.),
+])
+def test_powerlaw_singleexp_jac(p):
+    jac = powerlaw_singleexp_jac(X, *p)
+    expected = numerical_jac(powerlaw_singleexp, X, p)
+
+    assert jac.shape == (X.size, 5)
+    assert np.any(X < p[1])
+
+    scale = np.max(np.abs(expected), axis=0) + 1.
+    np.testing.assert_allclose(jac / scale, expected / scale, atol=1e-6)
+
+
+def test_jac_pedestal_region():
+    x = np.linspace(0., 3., 7)
+
+    jac = powerlaw_doubleexp_jac(x, 1000., 3.5, 0.66, 0.96, 1500., 0.56, 2.77)
+
+    np.testing.assert_array_equal(jac[:,4], 1.)
+    np.testing.assert_array_equal(np.delete(jac, 4, axis=1), 0.)